@@ -0,0 +1,239 @@
+import argparse
+import itertools
+import json
+import time
+import tracemalloc
+from typing import Any, Dict, List, Tuple
+
+import cv2
+import numpy as np
+
+from config.calibration_store import load_calibration_file, scale_camera_matrix
+from config.config import ConfigStore, LocalConfig, RemoteConfig
+from pipeline.CameraPoseEstimator import MultiTargetCameraPoseEstimator
+from pipeline.tag_layout import TagLayoutIndex, quaternion_to_rotation_matrix
+from pipeline.TagDetector import ArucoTagDetector
+from pipeline.undistortion import set_calibration
+
+ARUCO_DICT = cv2.aruco.DICT_APRILTAG_36h11
+MARKER_CELL_PX = 24
+BACKGROUND = 110
+
+
+class SyntheticSceneRenderer:
+    """Renders the tags of a layout as seen by a calibrated camera at a known pose.
+
+    Tags are drawn with an ideal pinhole projection and the whole frame is then distorted with the calibration's
+    distortion model, so detected corners can be compared against ground truth.
+    """
+
+    def __init__(self, layout_index: TagLayoutIndex, camera_matrix: np.ndarray, distortion_coefficients: np.ndarray,
+                 resolution: Tuple[int, int]) -> None:
+        self._layout_index = layout_index
+        self._camera_matrix = camera_matrix
+        self._resolution = resolution
+        self._dictionary = cv2.aruco.getPredefinedDictionary(ARUCO_DICT)
+        self._markers: Dict[int, np.ndarray] = {}
+
+        # For every distorted output pixel, look up the ideal pinhole pixel it shows
+        width, height = resolution
+        grid = np.stack(np.meshgrid(np.arange(width), np.arange(height)), axis=-1).reshape(-1, 1, 2)
+        ideal = cv2.undistortPoints(grid.astype(np.float64), camera_matrix, distortion_coefficients,
+                                    P=camera_matrix).reshape(height, width, 2)
+        self._map_x = ideal[:, :, 0].astype(np.float32)
+        self._map_y = ideal[:, :, 1].astype(np.float32)
+
+    def _get_marker(self, tag_id: int) -> np.ndarray:
+        # Marker with a one cell white quiet zone
+        if tag_id not in self._markers:
+            side = (self._dictionary.markerSize + 2) * MARKER_CELL_PX
+            marker = cv2.aruco.generateImageMarker(self._dictionary, tag_id, side)
+            self._markers[tag_id] = cv2.copyMakeBorder(marker, MARKER_CELL_PX, MARKER_CELL_PX, MARKER_CELL_PX,
+                                                       MARKER_CELL_PX, cv2.BORDER_CONSTANT, value=255)
+        return self._markers[tag_id]
+
+    def render(self, rvec: np.ndarray, tvec: np.ndarray, blur_sigma: float, noise_sigma: float,
+               rng: np.random.Generator) -> np.ndarray:
+        width, height = self._resolution
+        image = np.full((height, width), BACKGROUND, dtype=np.uint8)
+        rotation, _ = cv2.Rodrigues(rvec)
+
+        for tag_id in self._layout_index.tag_ids:
+            # Skip tags behind the camera or facing away from it
+            corners = self._layout_index.corners[tag_id]
+            camera_corners = corners @ rotation.T + tvec.reshape(1, 3)
+            if np.any(camera_corners[:, 2] < 0.1):
+                continue
+            projected = camera_corners[:, :2] / camera_corners[:, 2:] * np.diag(self._camera_matrix)[:2] + \
+                self._camera_matrix[:2, 2]
+            edge_a, edge_b = projected[1] - projected[0], projected[3] - projected[0]
+            if edge_a[0] * edge_b[1] - edge_a[1] * edge_b[0] <= 0:
+                continue
+
+            # Map the black square of the marker onto the projected tag corners
+            if np.any(np.abs(projected - self._camera_matrix[:2, 2]) > 4 * max(width, height)):
+                continue
+            marker = self._get_marker(tag_id)
+            low, high = MARKER_CELL_PX - 0.5, marker.shape[0] - MARKER_CELL_PX - 0.5
+            source = np.array([[low, low], [high, low], [high, high], [low, high]], dtype=np.float32)
+            homography = cv2.getPerspectiveTransform(source, projected.astype(np.float32))
+            warped = cv2.warpPerspective(marker, homography, (width, height), flags=cv2.INTER_LINEAR, borderValue=0)
+            mask = cv2.warpPerspective(np.full_like(marker, 255), homography, (width, height), flags=cv2.INTER_NEAREST)
+            image[mask > 0] = warped[mask > 0]
+
+        image = cv2.remap(image, self._map_x, self._map_y, cv2.INTER_LINEAR, borderValue=BACKGROUND)
+        if blur_sigma > 0:
+            image = cv2.GaussianBlur(image, (0, 0), blur_sigma)
+        if noise_sigma > 0:
+            image = np.clip(image + rng.normal(0, noise_sigma, image.shape), 0, 255).astype(np.uint8)
+        return image
+
+
+def load_calibration(path: str, resolution: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray]:
+    """Load a saved calibration, scaling the camera matrix to a resolution with the same aspect ratio."""
+    calibration = load_calibration_file('', path)
+    camera_matrix = calibration.camera_matrix
+    if calibration.img_size is not None:
+        camera_matrix = scale_camera_matrix(calibration.camera_matrix, calibration.img_size, resolution)
+        if camera_matrix is None:
+            raise ValueError('Resolution ' + str(resolution) + ' does not match the calibration aspect ratio')
+    return camera_matrix, calibration.distortion_coefficients
+
+
+def generate_camera_pose(layout_index: TagLayoutIndex, tag_layout: Any, distance: float,
+                         rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Place a camera in front of a random tag, returning OpenCV rvec, tvec and the position in field coordinates."""
+    tag_data = tag_layout['tags'][rng.integers(len(tag_layout['tags']))]
+    translation = tag_data['pose']['translation']
+    quaternion = tag_data['pose']['rotation']['quaternion']
+    tag_rotation = quaternion_to_rotation_matrix(quaternion['W'], quaternion['X'], quaternion['Y'], quaternion['Z'])
+    tag_position = np.array([translation['x'], translation['y'], translation['z']])
+
+    # Stand off along the tag normal with some lateral and vertical offset, aiming near the tag
+    normal, lateral = tag_rotation[:, 0], tag_rotation[:, 1]
+    position = tag_position + distance * normal + rng.uniform(-0.4, 0.4) * distance * lateral + \
+        np.array([0.0, 0.0, rng.uniform(-0.3, 0.3)])
+    target = tag_position + rng.uniform(-0.1, 0.1, 3) * distance
+
+    # Camera basis in OpenCV field coordinates (X right, Y down, Z forward)
+    position_cv = np.array([-position[1], -position[2], position[0]])
+    target_cv = np.array([-target[1], -target[2], target[0]])
+    forward = target_cv - position_cv
+    forward /= np.linalg.norm(forward)
+    right = np.cross(np.array([0.0, 1.0, 0.0]), forward)
+    right /= np.linalg.norm(right)
+    down = np.cross(forward, right)
+    rotation = np.stack([right, down, forward])
+    rvec, _ = cv2.Rodrigues(rotation)
+    return rvec, -rotation @ position_cv, position
+
+
+def run_benchmark(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    with open(args.layout, 'r') as layout_file:
+        tag_layout = json.loads(layout_file.read())
+    layout_index = TagLayoutIndex(tag_layout, args.tag_size)
+    rng = np.random.default_rng(args.seed)
+    results = []
+
+    for resolution_str in args.resolutions:
+        resolution = tuple(int(value) for value in resolution_str.split('x'))
+        camera_matrix, distortion_coefficients = load_calibration(args.calibration, resolution)
+        renderer = SyntheticSceneRenderer(layout_index, camera_matrix, distortion_coefficients, resolution)
+
+        config_store = ConfigStore(LocalConfig(), RemoteConfig())
+        set_calibration(config_store, camera_matrix, distortion_coefficients)
+        config_store.set_remote('tag_size_m', args.tag_size)
+        config_store.set_remote('tag_layout', tag_layout)
+        config_store.set_remote('detector_decimation', args.decimation)
+        tag_detector = ArucoTagDetector(ARUCO_DICT)
+        pose_estimator = MultiTargetCameraPoseEstimator()
+
+        for distance, blur_sigma, noise_sigma in itertools.product(args.distances, args.blur, args.noise):
+            detect_times, solve_times, python_heap_peaks, translation_errors, rotation_errors = [], [], [], [], []
+            for _ in range(args.frames):
+                rvec, tvec, position = generate_camera_pose(layout_index, tag_layout, distance, rng)
+                image = renderer.render(rvec, tvec, blur_sigma, noise_sigma, rng)
+
+                detect_start = time.perf_counter()
+                image_observations = tag_detector.detect_tags(image, config_store)
+                solve_start = time.perf_counter()
+                pose_observation = pose_estimator.solve_camera_pose(image_observations, config_store)
+                solve_end = time.perf_counter()
+
+                # Tracing slows allocations down, so the Python heap is measured in a second, untimed pass. OpenCV's
+                # native allocations are not traced.
+                tracemalloc.start()
+                pose_estimator.solve_camera_pose(tag_detector.detect_tags(image, config_store), config_store)
+                python_heap_peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+
+                detect_times.append(solve_start - detect_start)
+                solve_times.append(solve_end - solve_start)
+                if pose_observation is None:
+                    continue
+
+                # Compare the camera position and viewing direction against ground truth
+                pose = pose_observation.pose_0
+                estimated = np.array([pose.translation().X(), pose.translation().Y(), pose.translation().Z()])
+                translation_errors.append(np.linalg.norm(estimated - position))
+                quaternion = pose.rotation().getQuaternion()
+                estimated_forward = quaternion_to_rotation_matrix(quaternion.W(), quaternion.X(), quaternion.Y(),
+                                                                  quaternion.Z())[:, 0]
+                rotation_matrix, _ = cv2.Rodrigues(rvec)
+                forward_cv = rotation_matrix[2]
+                true_forward = np.array([forward_cv[2], -forward_cv[0], -forward_cv[1]])
+                rotation_errors.append(np.degrees(np.arccos(np.clip(np.dot(estimated_forward, true_forward), -1, 1))))
+
+            results.append({
+                'resolution': resolution_str,
+                'distance_m': distance,
+                'blur_sigma': blur_sigma,
+                'noise_sigma': noise_sigma,
+                'detect_fps': 1.0 / np.mean(detect_times),
+                'solve_fps': 1.0 / np.mean(solve_times),
+                'detect_p95_ms': float(np.percentile(detect_times, 95) * 1000),
+                'solve_p95_ms': float(np.percentile(solve_times, 95) * 1000),
+                'python_heap_peak_kb': float(np.mean(python_heap_peaks) / 1024),
+                'solve_rate': len(translation_errors) / args.frames,
+                'translation_error_m': float(np.median(translation_errors)) if translation_errors else None,
+                'rotation_error_deg': float(np.median(rotation_errors)) if rotation_errors else None
+            })
+            print_result(results[-1])
+    return results
+
+
+def print_result(result: Dict[str, Any]) -> None:
+    def format_error(value: Any, digits: int) -> str:
+        return 'n/a' if value is None else str(round(value, digits))
+
+    print(result['resolution'], 'distance', result['distance_m'], 'blur', result['blur_sigma'], 'noise',
+          result['noise_sigma'], '| detect', round(result['detect_fps'], 1), 'fps (p95',
+          round(result['detect_p95_ms'], 2), 'ms) | solve', round(result['solve_fps'], 1), 'fps (p95',
+          round(result['solve_p95_ms'], 2), 'ms) | python heap peak', round(result['python_heap_peak_kb']),
+          'KB | solved', str(round(result['solve_rate'] * 100)) + '% | error',
+          format_error(result['translation_error_m'], 4), 'm', format_error(result['rotation_error_deg'], 3), 'deg')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render synthetic tag scenes and benchmark detection and solving')
+    parser.add_argument('layout', help='tag layout JSON, as published to the tag_layout topic')
+    parser.add_argument('calibration', help='calibration JSON, for example from saved_calibrations/')
+    parser.add_argument('--tag-size', type=float, default=RemoteConfig.tag_size_m, help='tag size in meters')
+    parser.add_argument('--resolutions', nargs='+', default=['1600x1200'], help='resolutions as WIDTHxHEIGHT')
+    parser.add_argument('--distances', nargs='+', type=float, default=[1.0, 3.0, 5.0], help='camera distances (m)')
+    parser.add_argument('--blur', nargs='+', type=float, default=[0.0], help='gaussian blur sigmas (px)')
+    parser.add_argument('--noise', nargs='+', type=float, default=[0.0], help='gaussian noise sigmas')
+    parser.add_argument('--decimation', type=int, default=RemoteConfig.detector_decimation, help='detector decimation')
+    parser.add_argument('--frames', type=int, default=50, help='frames per configuration')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for camera poses and noise')
+    parser.add_argument('--output', help='write results to a JSON file')
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    if args.output is not None:
+        with open(args.output, 'w') as output:
+            output.write(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
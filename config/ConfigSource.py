@@ -1,94 +1,205 @@
+import dataclasses
 import json
+import math
+import os
+from typing import Any, Dict, List, Union
 
-import cv2
 import ntcore
-import numpy as np
 
 from config.config import ConfigStore, RemoteConfig
+from config.calibration_store import CalibrationStore
+from pipeline.undistortion import set_calibration
 
 class ConfigSource:
     def update(self, config_store: ConfigStore) -> None:
         raise NotImplementedError
 
 class FileConfigSource(ConfigSource):
+    """Reads the local config from config.json.
+
+    With a camera index, the entry of the "cameras" list at that index overrides the top level settings, so each camera
+    of a multi-camera device has its own device_id, calibration and stream settings.
+    """
     CONFIG_FILENAME = 'config.json'
-    CALIBRATION_FILENAME = 'calibration.json'
+    OPTIONAL_FIELDS = ('stream_scale', 'stream_quality', 'stream_max_fps', 'stream_max_clients', 'detector',
+                       'detector_workers', 'detector_tile_processes', 'detector_tile_rows', 'detector_tile_cols',
+                       'detector_tile_overlap_px', 'record_path', 'record_jpeg_quality', 'calibration_file',
+                       'calibration_camera', 'robot_to_camera', 'fuse_cameras', 'fusion_max_offset_ms',
+                       'frame_bus_name', 'frame_bus_slots', 'frame_bus_source')
+
+    def __init__(self, camera_index: Union[int, None] = None) -> None:
+        self._camera_index = camera_index
 
-    def __int__(self) -> None:
-        pass
+    @classmethod
+    def get_camera_count(cls) -> int:
+        """Return the number of entries in the cameras list, or 0 for a single camera configured at the top level."""
+        with open(cls.CONFIG_FILENAME, 'r') as config_file:
+            return len(json.loads(config_file.read()).get('cameras', []))
 
     def update(self, config_store: ConfigStore) -> None:
         with open(self.CONFIG_FILENAME, 'r') as config_file:
             config_data = json.loads(config_file.read())
+            if self._camera_index is not None:
+                config_data = dict(config_data, **config_data['cameras'][self._camera_index])
 
-            config_store.local_config.device_id = config_data['device_id']
-            config_store.local_config.server_ip = config_data['server_ip']
-            config_store.local_config.stream_port = config_data['stream_port']
+            config_store.set_local('device_id', config_data['device_id'])
+            config_store.set_local('server_ip', config_data['server_ip'])
+            config_store.set_local('stream_port', config_data['stream_port'])
 
-        # calibration_store = cv2.FileStorage(self.CALIBRATION_FILENAME, cv2.FILE_STORAGE_READ)
-        # camera_matrix = calibration_store.getNode('camera_matrix').mat()
-        # distortion_coefficients = calibration_store.getNode('distortion_coefficients').mat()
-        # calibration_store.release()
+            # Optional settings keep their LocalConfig defaults when not present
+            for name in self.OPTIONAL_FIELDS:
+                if name in config_data:
+                    config_store.set_local(name, config_data[name])
 
-        with open(self.CALIBRATION_FILENAME, 'r') as calib_file:
-            calib_data = json.loads(calib_file.read())
+class CalibrationConfigSource(ConfigSource):
+    """Applies the calibration for the current camera resolution whenever the resolution changes.
 
-            camera_matrix = np.array(calib_data['camera_matrix'])
-            distortion_coefficients = np.array(calib_data['distortion_coefficients'])
+    calibration_file is preferred, then the saved calibrations of calibration_camera. Camera matrices are scaled to
+    resolutions with the same aspect ratio. has_calibration is cleared when no calibration fits, so poses are never
+    solved with a camera matrix for another resolution.
+    """
+    SAVED_CALIBRATIONS_DIRECTORY = 'saved_calibrations'
+    # Camera name of calibration_file in the store
+    LOCAL_CAMERA = ''
 
-            config_store.local_config.camera_matrix = camera_matrix
-            config_store.local_config.distortion_coefficients = distortion_coefficients
-            config_store.local_config.has_calibration = True
+    def __init__(self, calibration_file: str) -> None:
+        self._store = CalibrationStore(self.SAVED_CALIBRATIONS_DIRECTORY)
+        if os.path.exists(calibration_file):
+            self._store.add(self.LOCAL_CAMERA, calibration_file)
+        self._config_version = -1
 
-        # if camera_matrix is np.array and distortion_coefficients is np.array:
-        #     print('hello')
-        #     config_store.local_config.camera_matrix = camera_matrix
-        #     config_store.local_config.distortion_coefficients = distortion_coefficients
-        #     config_store.local_config.has_calibration = True
-        # print('wow')
+    def has_calibrations(self, config_store: ConfigStore) -> bool:
+        """Return whether any calibration of the camera was found, whether or not it fits the current resolution."""
+        return self._store.contains((self.LOCAL_CAMERA, config_store.local_config.calibration_camera))
+
+    def update(self, config_store: ConfigStore) -> None:
+        config_version = config_store.field_version('camera_resolution_width', 'camera_resolution_height',
+                                                    'calibration_camera')
+        if config_version == self._config_version:
+            return
+        self._config_version = config_version
+
+        resolution = (config_store.remote_config.camera_resolution_width,
+                      config_store.remote_config.camera_resolution_height)
+        result = self._store.get((self.LOCAL_CAMERA, config_store.local_config.calibration_camera), resolution)
+        if result is None:
+            print('No calibration for resolution ' + str(resolution[0]) + 'x' + str(resolution[1]))
+            config_store.set_local('has_calibration', False)
+            return
+        calibration, camera_matrix = result
+        print('Using calibration ' + calibration.path + ' for resolution ' + str(resolution[0]) + 'x' +
+              str(resolution[1]))
+        set_calibration(config_store, camera_matrix, calibration.distortion_coefficients)
 
 class NTConfigSource(ConfigSource):
+    """Applies remote config published to NetworkTables.
+
+    The last received config is cached to disk and applied on startup, so the camera can be opened with the right
+    settings and tags solved before NetworkTables connects.
+    """
+    CACHE_FILENAME_FORMAT = 'remote_config_cache_{}.json'
+
+    _TOPIC_GETTERS = {
+        int: ntcore.NetworkTable.getIntegerTopic,
+        float: ntcore.NetworkTable.getDoubleTopic,
+        bool: ntcore.NetworkTable.getBooleanTopic,
+        str: ntcore.NetworkTable.getStringTopic
+    }
+
     _init_complete: bool = False
-    _camera_id_sub: ntcore.IntegerSubscriber
-    _camera_resolution_width_sub: ntcore.IntegerSubscriber
-    _camera_resolution_height_sub: ntcore.IntegerSubscriber
-    _camera_auto_exposure_sub: ntcore.IntegerSubscriber
-    _camera_exposure_sub: ntcore.IntegerSubscriber
-    _camera_gain_sub: ntcore.IntegerSubscriber
-    _tag_size_m_sub: ntcore.DoubleSubscriber
-    _tag_layout_sub: ntcore.StringSubscriber
+    _field_types: Dict[str, type] = {config_field.name: config_field.type
+                                     for config_field in dataclasses.fields(RemoteConfig)}
+    _subscribers: List[ntcore.Subscriber]
+    _field_names: Dict[str, str]
+    _poller: ntcore.NetworkTableListenerPoller
+    _tag_layout_data: Union[str, None] = None
 
     def update(self, config_store: ConfigStore) -> None:
-        # Initialize subscribers on first call
+        # Initialize subscribers on first call, the poller reports current values and then only changes
         if not self._init_complete:
-            nt_table = ntcore.NetworkTableInstance.getDefault().getTable(
-                "/" + config_store.local_config.device_id + '/config')
-            self._camera_id_sub = nt_table.getIntegerTopic('camera_id').subscribe(RemoteConfig.camera_id)
-            self._camera_resolution_width_sub = nt_table.getIntegerTopic(
-                'camera_resolution_width').subscribe(RemoteConfig.camera_resolution_width)
-            self._camera_resolution_height_sub = nt_table.getIntegerTopic(
-                'camera_resolution_height').subscribe(RemoteConfig.camera_resolution_height)
-            self._camera_auto_exposure_sub = nt_table.getIntegerTopic(
-                'camera_auto_exposure').subscribe(RemoteConfig.camera_auto_exposure)
-            self._camera_exposure_sub = nt_table.getIntegerTopic(
-                'camera_exposure').subscribe(RemoteConfig.camera_exposure)
-            self._camera_gain_sub = nt_table.getIntegerTopic(
-                'camera_gain').subscribe(RemoteConfig.camera_gain)
-            self._tag_size_m_sub = nt_table.getDoubleTopic(
-                'tag_size_m').subscribe(RemoteConfig.tag_size_m)
-            self._tag_layout_sub = nt_table.getStringTopic('tag_layout').subscribe('')
+            self._load_cache(config_store)
+            nt_instance = ntcore.NetworkTableInstance.getDefault()
+            nt_table = nt_instance.getTable('/' + config_store.local_config.device_id + '/config')
+            self._poller = ntcore.NetworkTableListenerPoller(nt_instance)
+            self._subscribers = []
+            self._field_names = {}
+            for config_field in dataclasses.fields(RemoteConfig):
+                if config_field.name == 'tag_layout':
+                    topic = nt_table.getStringTopic(config_field.name)
+                    subscriber = topic.subscribe('')
+                else:
+                    topic = self._TOPIC_GETTERS[config_field.type](nt_table, config_field.name)
+                    subscriber = topic.subscribe(config_field.default)
+                self._subscribers.append(subscriber)
+                self._field_names[topic.getName()] = config_field.name
+                self._poller.addListener(subscriber, ntcore.EventFlags.kValueAll | ntcore.EventFlags.kImmediate)
             self._init_complete = True
 
-        # Read config data
-        config_store.remote_config.camera_id = self._camera_id_sub.get()
-        config_store.remote_config.camera_resolution_width = self._camera_resolution_width_sub.get()
-        config_store.remote_config.camera_resolution_height = self._camera_resolution_height_sub.get()
-        config_store.remote_config.camera_auto_exposure = self._camera_auto_exposure_sub.get()
-        config_store.remote_config.camera_exposure = self._camera_exposure_sub.get()
-        config_store.remote_config.camera_gain = self._camera_gain_sub.get()
-        config_store.remote_config.tag_size_m = self._tag_size_m_sub.get()
+        # Apply changed values
+        changed = False
+        for event in self._poller.readQueue():
+            if not isinstance(event.data, ntcore.ValueEventData):
+                continue
+            name = self._field_names.get(event.data.topic.getName())
+            if name == 'tag_layout':
+                changed = self._update_tag_layout(config_store, event.data.value.value()) or changed
+            elif name is not None:
+                changed = self._set_typed(config_store, name, event.data.value.value()) or changed
+        if changed:
+            self._save_cache(config_store)
+
+    def _set_typed(self, config_store: ConfigStore, name: str, value: Any) -> bool:
+        # Values arrive as published, e.g. a dashboard may publish 2.0 to an integer topic. Convert numbers like the
+        # typed subscribers do and ignore values of another type.
+        field_type = self._field_types[name]
+        if field_type in (int, float) and isinstance(value, (int, float)) and not isinstance(value, bool):
+            if not math.isfinite(value):
+                print('Ignoring non-finite value for ' + name + ':', value)
+                return False
+            if field_type is int and value != int(value):
+                print('Ignoring non-integer value for ' + name + ':', value)
+                return False
+            return config_store.set_remote(name, field_type(value))
+        if isinstance(value, field_type):
+            return config_store.set_remote(name, value)
+        print('Ignoring value of the wrong type for ' + name + ':', value)
+        return False
+
+    def _update_tag_layout(self, config_store: ConfigStore, tag_layout_data: str) -> bool:
+        # Only parse the layout when the published string changes
+        if tag_layout_data == self._tag_layout_data:
+            return False
+        self._tag_layout_data = tag_layout_data
         try:
-            config_store.remote_config.tag_layout = json.loads(self._tag_layout_sub.get())
+            return config_store.set_remote('tag_layout', json.loads(tag_layout_data))
         except:
-            config_store.remote_config.tag_layout = None
-            pass
\ No newline at end of file
+            return config_store.set_remote('tag_layout', None)
+
+    def _load_cache(self, config_store: ConfigStore) -> None:
+        cache_filename = self.CACHE_FILENAME_FORMAT.format(config_store.local_config.device_id)
+        if not os.path.exists(cache_filename):
+            return
+        try:
+            with open(cache_filename, 'r') as cache_file:
+                cache_data = json.loads(cache_file.read())
+        except Exception as e:
+            print('Failed to read remote config cache:', e)
+            return
+        for config_field in dataclasses.fields(RemoteConfig):
+            if config_field.name not in cache_data:
+                continue
+            if config_field.name == 'tag_layout':
+                config_store.set_remote(config_field.name, cache_data[config_field.name])
+            else:
+                # Caches written before values were converted may hold numbers of the wrong type
+                self._set_typed(config_store, config_field.name, cache_data[config_field.name])
+
+    def _save_cache(self, config_store: ConfigStore) -> None:
+        # Write to a temporary file first so a power loss never leaves a partial cache
+        cache_filename = self.CACHE_FILENAME_FORMAT.format(config_store.local_config.device_id)
+        try:
+            with open(cache_filename + '.tmp', 'w') as cache_file:
+                cache_file.write(json.dumps(dataclasses.asdict(config_store.remote_config)))
+            os.replace(cache_filename + '.tmp', cache_filename)
+        except Exception as e:
+            print('Failed to write remote config cache:', e)
@@ -0,0 +1,86 @@
+import glob
+import json
+import os
+from dataclasses import dataclass
+from typing import List, Tuple, Union
+
+import numpy as np
+import numpy.typing
+
+
+@dataclass
+class SavedCalibration:
+    camera: str
+    path: str
+    # None for old calibrations without img_size, which are assumed to match any resolution
+    img_size: Union[Tuple[int, int], None]
+    camera_matrix: np.typing.NDArray[np.float64]
+    distortion_coefficients: np.typing.NDArray[np.float64]
+
+
+def scale_camera_matrix(camera_matrix: np.typing.NDArray[np.float64], img_size: Tuple[int, int],
+                        resolution: Tuple[int, int]) -> Union[np.typing.NDArray[np.float64], None]:
+    """Scale a camera matrix to a resolution with the same aspect ratio, or return None if the aspect ratio differs."""
+    if resolution[0] * img_size[1] != resolution[1] * img_size[0]:
+        return None
+    scale = resolution[0] / img_size[0]
+    scaled_matrix = camera_matrix.copy()
+    scaled_matrix[0, 0] *= scale
+    scaled_matrix[1, 1] *= scale
+    # Pixel centers, not edges, scale with the image
+    scaled_matrix[:2, 2] = (camera_matrix[:2, 2] + 0.5) * scale - 0.5
+    return scaled_matrix
+
+
+def load_calibration_file(camera: str, path: str) -> SavedCalibration:
+    with open(path, 'r') as calib_file:
+        calib_data = json.loads(calib_file.read())
+    img_size = tuple(calib_data['img_size']) if 'img_size' in calib_data else None
+    return SavedCalibration(camera, path, img_size, np.array(calib_data['camera_matrix']),
+                            np.array(calib_data['distortion_coefficients']))
+
+
+class CalibrationStore:
+    """Calibrations of each camera at the resolutions they were captured at.
+
+    A camera's calibrations are saved_calibrations/<camera>.json or any file in saved_calibrations/<camera>/.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self._calibrations: List[SavedCalibration] = []
+        for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+            self.add(os.path.splitext(os.path.basename(path))[0], path)
+        for path in sorted(glob.glob(os.path.join(directory, '*', '*.json'))):
+            self.add(os.path.basename(os.path.dirname(path)), path)
+
+    def add(self, camera: str, path: str) -> None:
+        try:
+            self._calibrations.append(load_calibration_file(camera, path))
+        except Exception as e:
+            print('Failed to load calibration ' + path + ':', e)
+
+    def contains(self, cameras: Tuple[str, ...]) -> bool:
+        """Return whether any of the cameras has a calibration, at any resolution."""
+        return any(calibration.camera in cameras for calibration in self._calibrations)
+
+    def get(self, cameras: Tuple[str, ...],
+            resolution: Tuple[int, int]) -> Union[Tuple[SavedCalibration, np.typing.NDArray[np.float64]], None]:
+        """Return the best calibration of the cameras for a resolution and its camera matrix scaled to that resolution.
+
+        An exact resolution match is preferred, then the largest calibration with the same aspect ratio. Earlier
+        cameras win ties.
+        """
+        calibrations = [calibration for camera in cameras for calibration in self._calibrations
+                        if calibration.camera == camera]
+        for calibration in calibrations:
+            if calibration.img_size == resolution:
+                return calibration, calibration.camera_matrix
+        for calibration in sorted([calibration for calibration in calibrations if calibration.img_size is not None],
+                                  key=lambda calibration: calibration.img_size[0], reverse=True):
+            camera_matrix = scale_camera_matrix(calibration.camera_matrix, calibration.img_size, resolution)
+            if camera_matrix is not None:
+                return calibration, camera_matrix
+        for calibration in calibrations:
+            if calibration.img_size is None:
+                return calibration, calibration.camera_matrix
+        return None
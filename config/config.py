@@ -1,4 +1,5 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Any, Dict, List
 import numpy as np
 import numpy.typing
 
@@ -8,9 +9,32 @@ class LocalConfig:
     device_id: str = ''
     server_ip: str = ''
     stream_port: int = 8000
+    stream_scale: float = 0.5
+    stream_quality: int = 75
+    stream_max_fps: float = 15.0
+    stream_max_clients: int = 4
+    detector: str = 'aruco'
+    detector_workers: int = 1
+    detector_tile_processes: int = 0
+    detector_tile_rows: int = 2
+    detector_tile_cols: int = 2
+    detector_tile_overlap_px: int = 200
+    record_path: str = ''
+    record_jpeg_quality: int = 0
+    calibration_file: str = 'calibration.json'
+    calibration_camera: str = ''
+    # Camera pose on the robot, [x, y, z, roll, pitch, yaw] in meters and radians, empty if unknown
+    robot_to_camera: List[float] = field(default_factory=list)
+    fuse_cameras: bool = False
+    fusion_max_offset_ms: float = 10.0
+    frame_bus_name: str = ''
+    frame_bus_slots: int = 4
+    frame_bus_source: str = ''
     has_calibration: bool = False
-    camera_matrix: np.typing.NDArray[np.float64] = np.array([])
-    distortion_coefficients: np.typing.NDArray[np.float64] = np.array([])
+    camera_matrix: np.typing.NDArray[np.float64] = field(default_factory=lambda: np.array([]))
+    distortion_coefficients: np.typing.NDArray[np.float64] = field(default_factory=lambda: np.array([]))
+    # pipeline.undistortion.Undistorter for the current calibration
+    undistorter: Any = None
 
 @dataclass
 class RemoteConfig:
@@ -20,10 +44,53 @@ class RemoteConfig:
     camera_auto_exposure: int = 1
     camera_exposure: int = 20
     camera_gain: int = 25
+    camera_grayscale: bool = True
     tag_size_m: float = 0.2
     tag_layout: any = None
+    detector_tracking: bool = False
+    detector_full_scan_interval: int = 10
+    detector_roi_padding: float = 0.5
+    detector_decimation: int = 1
+    detector_refine_window: int = 5
+    apriltag_threads: int = 4
+    apriltag_quad_sigma: float = 0.0
+    apriltag_min_decision_margin: float = 0.0
+    solver_tracking: bool = False
+    solver_tracking_max_error: float = 2.0
+    output_tag_poses: bool = False
 
 @dataclass
 class ConfigStore:
     local_config: LocalConfig
     remote_config: RemoteConfig
+    # Incremented on every field change, each changed field records the version it changed at
+    version: int = 0
+    _field_versions: Dict[str, int] = field(default_factory=dict)
+
+    def set_local(self, name: str, value: Any) -> bool:
+        """Set a local config field, returning whether it changed."""
+        current = getattr(self.local_config, name)
+        if isinstance(current, np.ndarray) or isinstance(value, np.ndarray):
+            changed = not np.array_equal(current, value)
+        else:
+            changed = current != value
+        if changed:
+            setattr(self.local_config, name, value)
+            self._bump(name)
+        return changed
+
+    def set_remote(self, name: str, value: Any) -> bool:
+        """Set a remote config field, returning whether it changed."""
+        if getattr(self.remote_config, name) == value:
+            return False
+        setattr(self.remote_config, name, value)
+        self._bump(name)
+        return True
+
+    def field_version(self, *names: str) -> int:
+        """Return the version at which any of the named fields last changed (0 if never)."""
+        return max(self._field_versions.get(name, 0) for name in names)
+
+    def _bump(self, name: str) -> None:
+        self.version += 1
+        self._field_versions[name] = self.version
@@ -0,0 +1,35 @@
+import datetime
+import os
+from typing import BinaryIO, Union
+
+import cv2
+
+from config.config import ConfigStore
+from pipeline.frame_log import FILE_MAGIC, get_config_snapshot, pack_config_chunk, pack_frame_chunk
+
+
+class FrameRecorder:
+    """Appends frames, capture timestamps and config snapshots to a recording for ReplayCapture."""
+
+    def __init__(self) -> None:
+        self._file: Union[BinaryIO, None] = None
+        self._config_version = -1
+
+    def start(self, config_store: ConfigStore) -> None:
+        os.makedirs(config_store.local_config.record_path, exist_ok=True)
+        path = os.path.join(config_store.local_config.record_path, config_store.local_config.device_id +
+                            datetime.datetime.now().strftime('_%Y%m%d_%H%M%S.rec'))
+        print('Recording to', path)
+        self._file = open(path, 'wb')
+        self._file.write(FILE_MAGIC)
+
+    def record(self, config_store: ConfigStore, sequence: int, timestamp: float, image: cv2.Mat) -> None:
+        if self._file is None:
+            return
+
+        # Snapshot the config whenever it changes
+        if config_store.version != self._config_version:
+            self._config_version = config_store.version
+            self._file.write(pack_config_chunk(get_config_snapshot(config_store)))
+        self._file.write(pack_frame_chunk(sequence, timestamp, image, config_store.local_config.record_jpeg_quality))
+        self._file.flush()
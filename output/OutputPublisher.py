@@ -1,22 +1,57 @@
 import math
-from typing import List, Union
+import time
+from typing import Dict, List, Union
 
 import ntcore
 from config.config import ConfigStore
-from vision_types import CameraPoseObservation, TagPoseObservation
+from output.tag_packing import TAG_PACKET_TYPE, pack_tag_poses
+from vision_types import CameraPoseObservation, TagImageObservation, TagPoseObservation
+from wpimath.geometry import Pose3d
 
 
 class OutputPublisher:
-    def send(self, config_store: ConfigStore, timestamp: float, observation: Union[CameraPoseObservation, None], fps: Union[int, None] = None) -> None:
+    def send(self, config_store: ConfigStore, sequence: int, timestamp: float, observation: Union[CameraPoseObservation, None], fps: Union[int, None] = None) -> None:
+        raise NotImplementedError
+
+    def send_fps(self, config_store: ConfigStore, fps: int) -> None:
+        raise NotImplementedError
+
+    def send_tag_poses(self, config_store: ConfigStore, sequence: int, timestamp: float,
+                       image_observations: List[TagImageObservation],
+                       tag_pose_observations: List[Union[TagPoseObservation, None]]) -> None:
+        raise NotImplementedError
+
+    def send_metrics(self, config_store: ConfigStore, metrics: Dict[str, Dict[str, float]]) -> None:
+        raise NotImplementedError
+
+    def send_drop_counts(self, config_store: ConfigStore, drop_counts: Dict[str, int]) -> None:
+        raise NotImplementedError
+
+    def send_startup_timings(self, config_store: ConfigStore, timings: Dict[str, float]) -> None:
         raise NotImplementedError
 
 
 class NT4OutputPublisher(OutputPublisher):
+    """Publishes observations to NetworkTables.
+
+    Capture timestamps are converted from time.monotonic() to the ntcore clock. ntcore applies its time sync offset
+    when sending, so the robot receives observations in server time.
+
+    Observations are [pose count, frame sequence number, poses..., tag IDs...]. Sequence numbers increase by one per
+    camera frame, so a gap means frames were lost and a repeated number a stale observation.
+    """
     _init_complete: bool = False
     _observations_pub: ntcore.DoubleArrayPublisher
     _fps_pub: ntcore.IntegerPublisher
+    # Created on the first frame with tag poses, most robots only read the observations
+    _tags_pub: Union[ntcore.RawPublisher, None] = None
+    _metrics_table: ntcore.NetworkTable
+    _metrics_pubs: Dict[str, ntcore.DoubleArrayPublisher]
+    _drop_pubs: Dict[str, ntcore.IntegerPublisher]
+    _startup_table: ntcore.NetworkTable
+    _startup_pubs: Dict[str, ntcore.DoublePublisher]
 
-    def send(self, config_store: ConfigStore, timestamp: float, observation: Union[CameraPoseObservation, None], fps: Union[int, None] = None) -> None:
+    def _init(self, config_store: ConfigStore) -> None:
         # Initialize publishers on first call
         if not self._init_complete:
             nt_table = ntcore.NetworkTableInstance.getDefault().getTable(
@@ -24,32 +59,85 @@ class NT4OutputPublisher(OutputPublisher):
             self._observations_pub = nt_table.getDoubleArrayTopic('observations').publish(
                 ntcore.PubSubOptions(periodic=0, sendAll=True, keepDuplicates=True))
             self._fps_pub = nt_table.getIntegerTopic('fps').publish()
+            self._metrics_table = ntcore.NetworkTableInstance.getDefault().getTable(
+                '/' + config_store.local_config.device_id + '/metrics')
+            self._metrics_pubs = {}
+            self._drop_pubs = {}
+            self._startup_table = ntcore.NetworkTableInstance.getDefault().getTable(
+                '/' + config_store.local_config.device_id + '/startup')
+            self._startup_pubs = {}
             self._init_complete = True
 
+    def send(self, config_store: ConfigStore, sequence: int, timestamp: float, observation: Union[CameraPoseObservation, None], fps: Union[int, None] = None) -> None:
+        self._init(config_store)
+
         # Send data
         if fps is not None:
             self._fps_pub.set(fps)
-        observation_data: List[float] = [0]
+        observation_data: List[float] = [0, sequence]
         if observation is not None:
             observation_data[0] = 1
-            observation_data.append(observation.error_0)
-            observation_data.append(observation.pose_0.translation().X())
-            observation_data.append(observation.pose_0.translation().Y())
-            observation_data.append(observation.pose_0.translation().Z())
-            observation_data.append(observation.pose_0.rotation().getQuaternion().W())
-            observation_data.append(observation.pose_0.rotation().getQuaternion().X())
-            observation_data.append(observation.pose_0.rotation().getQuaternion().Y())
-            observation_data.append(observation.pose_0.rotation().getQuaternion().Z())
+            self._append_pose(observation_data, observation.error_0, observation.pose_0)
             if observation.error_1 is not None and observation.pose_1 is not None:
                 observation_data[0] = 2
-                observation_data.append(observation.error_1)
-                observation_data.append(observation.pose_1.translation().X())
-                observation_data.append(observation.pose_1.translation().Y())
-                observation_data.append(observation.pose_1.translation().Z())
-                observation_data.append(observation.pose_1.rotation().getQuaternion().W())
-                observation_data.append(observation.pose_1.rotation().getQuaternion().X())
-                observation_data.append(observation.pose_1.rotation().getQuaternion().Y())
-                observation_data.append(observation.pose_1.rotation().getQuaternion().Z())
-            for tag_id in observation.tag_ids:
-                observation_data.append(tag_id)
-        self._observations_pub.set(observation_data, math.floor(timestamp * 1000000))
+                self._append_pose(observation_data, observation.error_1, observation.pose_1)
+            observation_data.extend(observation.tag_ids)
+        self._observations_pub.set(observation_data, self._get_nt_time(timestamp))
+
+    def send_fps(self, config_store: ConfigStore, fps: int) -> None:
+        self._init(config_store)
+        self._fps_pub.set(fps)
+
+    @staticmethod
+    def _append_pose(observation_data: List[float], error: float, pose: Pose3d) -> None:
+        # Each accessor builds a new wpimath object, so fetch them once per pose
+        translation = pose.translation()
+        quaternion = pose.rotation().getQuaternion()
+        observation_data.extend((error, translation.X(), translation.Y(), translation.Z(), quaternion.W(),
+                                 quaternion.X(), quaternion.Y(), quaternion.Z()))
+
+    def send_tag_poses(self, config_store: ConfigStore, sequence: int, timestamp: float,
+                       image_observations: List[TagImageObservation],
+                       tag_pose_observations: List[Union[TagPoseObservation, None]]) -> None:
+        self._init(config_store)
+        if self._tags_pub is None:
+            nt_table = ntcore.NetworkTableInstance.getDefault().getTable(
+                '/' + config_store.local_config.device_id + '/output')
+            self._tags_pub = nt_table.getRawTopic('tags').publish(
+                TAG_PACKET_TYPE, ntcore.PubSubOptions(periodic=0, sendAll=True, keepDuplicates=True))
+        self._tags_pub.set(pack_tag_poses(sequence, image_observations, tag_pose_observations),
+                           self._get_nt_time(timestamp))
+
+    @staticmethod
+    def _get_nt_time(timestamp: float) -> int:
+        return ntcore._now() - math.floor((time.monotonic() - timestamp) * 1000000)
+
+    def send_metrics(self, config_store: ConfigStore, metrics: Dict[str, Dict[str, float]]) -> None:
+        if not self._init_complete:
+            return
+
+        # Publish [p50, p95, p99] in milliseconds for each stage
+        for stage, summary in metrics.items():
+            if stage not in self._metrics_pubs:
+                self._metrics_pubs[stage] = self._metrics_table.getDoubleArrayTopic(stage + '_ms').publish()
+            self._metrics_pubs[stage].set([summary['p50_ms'], summary['p95_ms'], summary['p99_ms']])
+
+    def send_drop_counts(self, config_store: ConfigStore, drop_counts: Dict[str, int]) -> None:
+        if not self._init_complete:
+            return
+
+        # Publish the total frames dropped before each stage
+        for stage, dropped in drop_counts.items():
+            if stage not in self._drop_pubs:
+                self._drop_pubs[stage] = self._metrics_table.getIntegerTopic(stage + '_dropped').publish()
+            self._drop_pubs[stage].set(dropped)
+
+    def send_startup_timings(self, config_store: ConfigStore, timings: Dict[str, float]) -> None:
+        if not self._init_complete:
+            return
+
+        # Publish milliseconds since process start for each phase
+        for phase, milliseconds in timings.items():
+            if phase not in self._startup_pubs:
+                self._startup_pubs[phase] = self._startup_table.getDoubleTopic(phase + '_ms').publish()
+            self._startup_pubs[phase].set(milliseconds)
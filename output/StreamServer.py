@@ -1,11 +1,10 @@
-import socketserver
+import asyncio
+import json
 import threading
 import time
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from io import BytesIO
+from typing import Dict, Set, Union
 
 import cv2
-from PIL import Image
 
 from config.config import ConfigStore
 
@@ -16,91 +15,191 @@ class StreamServer:
         """Starts the output stream."""
         raise NotImplementedError
 
+    def wants_frame(self) -> bool:
+        """Returns whether the next frame would be served, so unwanted frames can skip overlay drawing."""
+        raise NotImplementedError
+
     def set_frame(self, frame: cv2.Mat) -> None:
         """Sets the frame to serve."""
         raise NotImplementedError
 
+    def set_metrics(self, metrics: Dict[str, Dict[str, float]]) -> None:
+        """Sets the pipeline metrics to serve."""
+        raise NotImplementedError
+
+
+class _StreamClient:
+    """Pending frame of one stream client. Newer frames replace a frame the client has not sent yet."""
+
+    def __init__(self) -> None:
+        self.frame_data = b''
+        self.has_frame = asyncio.Event()
+
 
-class MjpegServer(StreamServer):
-    _frame: cv2.Mat
-    _has_frame: bool = False
-
-    def _make_handler(self_mjpeg):  # type: ignore
-        class StreamingHandler(BaseHTTPRequestHandler):
-            HTML = '''
-                    <html>
-                        <head>
-                            <title>Polaris Debug</title>
-                            <style>
-                                body {
-                                    background-color: black;
-                                }
-                
-                                img {
-                                    position: absolute;
-                                    left: 50%;
-                                    top: 50%;
-                                    transform: translate(-50%, -50%);
-                                    max-width: 100%;
-                                    max-height: 100%;
-                                }
-                            </style>
-                        </head>
-                        <body>
-                            <img src="stream.mjpg" />
-                        </body>
-                    </html>
-                            '''
-
-            def do_GET(self):
-                if self.path == '/':
-                    content = self.HTML.encode('utf-8')
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'text/html')
-                    self.send_header('Content-Length', str(len(content)))
-                    self.end_headers()
-                    self.wfile.write(content)
-                elif self.path == '/stream.mjpg':
-                    self.send_response(200)
-                    self.send_header('Age', '0')
-                    self.send_header('Cache-Control', 'no-cache, private')
-                    self.send_header('Pragma', 'no-cache')
-                    self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
-                    self.end_headers()
-                    try:
-                        while True:
-                            if self_mjpeg._has_frame:
-                                pil_im = Image.fromarray(self_mjpeg._frame)
-                                stream = BytesIO()
-                                pil_im.save(stream, format='JPEG')
-                                frame_data = stream.getvalue()
-
-                                self.wfile.write(b'--FRAME\r\n')
-                                self.send_header('Content-Type', 'image/jpeg')
-                                self.send_header('Content-Length', str(len(frame_data)))
-                                self.end_headers()
-                                self.wfile.write(frame_data)
-                                self.wfile.write(b'\r\n')
-                            time.sleep(0.033)
-                    except Exception as e:
-                        print('Removed streaming client %s: %s', self.client_address, str(e))
-                else:
-                    self.send_error(404)
-                    self.end_headers()
-
-        return StreamingHandler
-
-    class StreamingServer(socketserver.ThreadingMixIn, HTTPServer):
-        allow_reuse_address = True
-        daemon_threads = True
-
-    def _run(self, port: int) -> None:
-        server = self.StreamingServer(('', port), self._make_handler())
-        server.serve_forever()
+class MjpegStream(StreamServer):
+    """One camera's MJPEG stream, served by an MjpegServer. Each frame is encoded once and only while clients are
+    connected.
+
+    Encoded frames are pushed to every client's single-frame slot, so a slow client skips frames and can never block
+    the pipeline.
+    """
+
+    def __init__(self, server: 'MjpegServer') -> None:
+        self._server = server
+        self._clients: Set[_StreamClient] = set()
+        self._client_count = 0
+        self._last_frame_time = 0.0
+        self._scale = 1.0
+        self._quality = 75
+        self._max_fps = 30.0
+        self._max_clients = 4
+        self.metrics_data = b'{}'
 
     def start(self, config_store: ConfigStore) -> None:
-        threading.Thread(target=self._run, daemon=True, args=(config_store.local_config.stream_port,)).start()
+        self._scale = config_store.local_config.stream_scale
+        self._quality = config_store.local_config.stream_quality
+        self._max_fps = config_store.local_config.stream_max_fps
+        self._max_clients = config_store.local_config.stream_max_clients
+
+    def wants_frame(self) -> bool:
+        # A max_fps of 0 or less leaves the frame rate unlimited
+        if self._client_count == 0:
+            return False
+        return self._max_fps <= 0 or time.time() - self._last_frame_time >= 1.0 / self._max_fps
 
     def set_frame(self, frame: cv2.Mat) -> None:
-        self._frame = frame.copy()
-        self._has_frame = True
+        loop = self._server.loop
+        if not self.wants_frame() or loop is None:
+            return
+        self._last_frame_time = time.time()
+
+        if self._scale != 1.0:
+            frame = cv2.resize(frame, None, fx=self._scale, fy=self._scale, interpolation=cv2.INTER_AREA)
+        _, frame_data = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self._quality])
+        loop.call_soon_threadsafe(self._publish, frame_data.tobytes())
+
+    def set_metrics(self, metrics: Dict[str, Dict[str, float]]) -> None:
+        self.metrics_data = json.dumps(metrics).encode('utf-8')
+
+    def _publish(self, frame_data: bytes) -> None:
+        for client in self._clients:
+            client.frame_data = frame_data
+            client.has_frame.set()
+
+    async def stream(self, writer: asyncio.StreamWriter) -> None:
+        if len(self._clients) >= self._max_clients:
+            MjpegServer.write_response(writer, '503 Service Unavailable', {}, b'')
+            return
+
+        writer.write(b'HTTP/1.0 200 OK\r\n'
+                     b'Age: 0\r\n'
+                     b'Cache-Control: no-cache, private\r\n'
+                     b'Pragma: no-cache\r\n'
+                     b'Content-Type: multipart/x-mixed-replace; boundary=FRAME\r\n\r\n')
+        client = _StreamClient()
+        self._clients.add(client)
+        self._client_count = len(self._clients)
+        try:
+            while True:
+                await client.has_frame.wait()
+                client.has_frame.clear()
+                frame_data = client.frame_data
+                writer.write(b'--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: ' +
+                             str(len(frame_data)).encode('latin-1') + b'\r\n\r\n' + frame_data + b'\r\n')
+                await asyncio.wait_for(writer.drain(), MjpegServer.WRITE_TIMEOUT_S)
+        finally:
+            self._clients.discard(client)
+            self._client_count = len(self._clients)
+
+
+class MjpegServer:
+    """HTTP server for the MJPEG streams of all cameras, running an asyncio event loop in its own thread.
+
+    A stream named '' is served at /, /stream.mjpg and /metrics, other streams under /<name>/.
+    """
+    HTML = '''
+            <html>
+                <head>
+                    <title>Polaris Debug</title>
+                    <style>
+                        body {
+                            background-color: black;
+                        }
+
+                        img {
+                            position: absolute;
+                            left: 50%;
+                            top: 50%;
+                            transform: translate(-50%, -50%);
+                            max-width: 100%;
+                            max-height: 100%;
+                        }
+                    </style>
+                </head>
+                <body>
+                    <img src="stream.mjpg" />
+                </body>
+            </html>
+                    '''
+    REQUEST_TIMEOUT_S = 10.0
+    WRITE_TIMEOUT_S = 5.0
+
+    def __init__(self) -> None:
+        self.loop: Union[asyncio.AbstractEventLoop, None] = None
+        self._streams: Dict[str, MjpegStream] = {}
+
+    def add_stream(self, name: str) -> MjpegStream:
+        stream = MjpegStream(self)
+        self._streams[name] = stream
+        return stream
+
+    def start(self, port: int) -> None:
+        threading.Thread(target=asyncio.run, daemon=True, args=(self._serve(port),)).start()
+
+    async def _serve(self, port: int) -> None:
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self._handle_connection, port=port, reuse_address=True)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            path = await asyncio.wait_for(self._read_request_path(reader), self.REQUEST_TIMEOUT_S)
+            name, _, resource = path[1:].rpartition('/')
+            stream = self._streams.get(name) if path.startswith('/') else None
+            if path == '/' and stream is None:
+                self.write_response(writer, '200 OK', {'Content-Type': 'text/html'}, self._get_index_html())
+            elif stream is None:
+                self.write_response(writer, '404 Not Found', {}, b'')
+            elif resource == '':
+                self.write_response(writer, '200 OK', {'Content-Type': 'text/html'}, self.HTML.encode('utf-8'))
+            elif resource == 'stream.mjpg':
+                await stream.stream(writer)
+            elif resource == 'metrics':
+                self.write_response(writer, '200 OK', {'Content-Type': 'application/json'}, stream.metrics_data)
+            else:
+                self.write_response(writer, '404 Not Found', {}, b'')
+            await asyncio.wait_for(writer.drain(), self.WRITE_TIMEOUT_S)
+        except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            print('Removed streaming client %s: %s' % (writer.get_extra_info('peername'), str(e)))
+        finally:
+            writer.close()
+
+    def _get_index_html(self) -> bytes:
+        links = ''.join('<p><a href="/' + name + '/">' + name + '</a></p>' for name in self._streams)
+        return ('<html><head><title>Polaris Debug</title></head><body>' + links + '</body></html>').encode('utf-8')
+
+    @staticmethod
+    async def _read_request_path(reader: asyncio.StreamReader) -> str:
+        request_line = (await reader.readline()).decode('latin-1').split()
+        while (await reader.readline()).strip() != b'':
+            pass
+        if len(request_line) < 2 or request_line[0] != 'GET':
+            return ''
+        return request_line[1]
+
+    @staticmethod
+    def write_response(writer: asyncio.StreamWriter, status: str, headers: Dict[str, str], content: bytes) -> None:
+        headers = dict(headers, **{'Content-Length': str(len(content))})
+        writer.write(('HTTP/1.0 ' + status + '\r\n' + ''.join(key + ': ' + value + '\r\n' for key, value in
+                                                             headers.items()) + '\r\n').encode('latin-1') + content)
@@ -0,0 +1,72 @@
+from typing import List, Tuple, Union
+
+import numpy as np
+import numpy.typing
+from vision_types import TagImageObservation, TagPoseObservation
+
+# NetworkTables type string of the packed tag topic, bumped when the layout changes
+TAG_PACKET_TYPE = 'polaris_tags_v1'
+
+# Little-endian header followed by tag_count records
+HEADER_DTYPE = np.dtype([('sequence', '<u4'), ('tag_count', '<u4')])
+# Camera to tag poses in WPILib coordinates, rotations as quaternions (w, x, y, z)
+TAG_DTYPE = np.dtype([('tag_id', '<i4'),
+                      ('distance', '<f4'),
+                      ('corners', '<f4', (4, 2)),
+                      ('error_0', '<f4'),
+                      ('translation_0', '<f4', (3,)),
+                      ('rotation_0', '<f4', (4,)),
+                      ('error_1', '<f4'),
+                      ('translation_1', '<f4', (3,)),
+                      ('rotation_1', '<f4', (4,))])
+
+
+def _opencv_to_wpilib(vectors: np.typing.NDArray[np.float64]) -> np.typing.NDArray[np.float64]:
+    # Same axis mapping as openCVPoseToWPILib, for translations and rotation vectors of shape (N, 3)
+    return vectors[:, [2, 0, 1]] * np.array([1.0, -1.0, -1.0])
+
+
+def _rotation_vectors_to_quaternions(rvecs: np.typing.NDArray[np.float64]) -> np.typing.NDArray[np.float64]:
+    angles = np.linalg.norm(rvecs, axis=1)
+    # sin(angle / 2) / angle, which tends to 1 / 2 for small angles
+    scales = np.where(angles > 1e-9, np.sin(angles / 2.0) / np.maximum(angles, 1e-9), 0.5)
+    return np.concatenate([np.cos(angles / 2.0)[:, np.newaxis], rvecs * scales[:, np.newaxis]], axis=1)
+
+
+def pack_tag_poses(sequence: int, image_observations: List[TagImageObservation],
+                   tag_pose_observations: List[Union[TagPoseObservation, None]]) -> bytes:
+    """Pack the corners and both IPPE poses of every solved tag into one buffer.
+
+    tag_pose_observations is aligned with image_observations, tags that could not be solved are left out.
+    """
+    solved = [(image_observation, tag_pose_observation)
+              for image_observation, tag_pose_observation in zip(image_observations, tag_pose_observations)
+              if tag_pose_observation is not None]
+    header = np.zeros(1, HEADER_DTYPE)
+    header['sequence'] = sequence
+    header['tag_count'] = len(solved)
+    if len(solved) == 0:
+        return header.tobytes()
+
+    # Both poses of all tags are converted in one batch, shape (len(solved) * 2, 3)
+    tvecs = _opencv_to_wpilib(np.array([(pose.tvec_0, pose.tvec_1) for _, pose in solved]).reshape(-1, 3))
+    quaternions = _rotation_vectors_to_quaternions(_opencv_to_wpilib(
+        np.array([(pose.rvec_0, pose.rvec_1) for _, pose in solved]).reshape(-1, 3)))
+    tags = np.zeros(len(solved), TAG_DTYPE)
+    tags['tag_id'] = [pose.tag_id for _, pose in solved]
+    tags['corners'] = np.array([image_observation.corners.reshape(4, 2) for image_observation, _ in solved])
+    tags['distance'] = np.linalg.norm(tvecs[0::2], axis=1)
+    tags['error_0'] = [pose.error_0 for _, pose in solved]
+    tags['error_1'] = [pose.error_1 for _, pose in solved]
+    tags['translation_0'] = tvecs[0::2]
+    tags['translation_1'] = tvecs[1::2]
+    tags['rotation_0'] = quaternions[0::2]
+    tags['rotation_1'] = quaternions[1::2]
+    return header.tobytes() + tags.tobytes()
+
+
+def unpack_tag_poses(data: bytes) -> Tuple[int, np.typing.NDArray[np.void]]:
+    """Return the sequence number and tag records of a packed buffer, the inverse of pack_tag_poses."""
+    header = np.frombuffer(data, HEADER_DTYPE, count=1)[0]
+    tags = np.frombuffer(data, TAG_DTYPE, count=int(header['tag_count']), offset=HEADER_DTYPE.itemsize)
+    return int(header['sequence']), tags
@@ -1,4 +1,4 @@
-from typing import List, Union
+from typing import List, Set, Union
 
 import cv2
 import numpy as np
@@ -6,8 +6,9 @@ from config.config import ConfigStore
 from vision_types import CameraPoseObservation, TagImageObservation
 from wpimath.geometry import *
 
-from pipeline.coordinate_systems import (openCVPoseToWPILib,
-                                         wpiLibTranslationToOpenCV)
+from pipeline.coordinate_systems import openCVPoseToWPILib
+from pipeline.tag_layout import TagLayoutIndex
+from pipeline.undistortion import Undistorter
 
 
 class CameraPoseEstimator:
@@ -15,62 +16,72 @@ class CameraPoseEstimator:
         raise NotImplementedError
 
 
+def _get_field_to_camera_pose(rvec: np.typing.NDArray[np.float64], tvec: np.typing.NDArray[np.float64]) -> Pose3d:
+    camera_to_field_pose = openCVPoseToWPILib(tvec, rvec)
+    camera_to_field = Transform3d(camera_to_field_pose.translation(), camera_to_field_pose.rotation())
+    field_to_camera = camera_to_field.inverse()
+    return Pose3d(field_to_camera.translation(), field_to_camera.rotation())
+
+
 class MultiTargetCameraPoseEstimator(CameraPoseEstimator):
+    """Solves the field to camera pose from all tags in the layout.
+
+    With solver_tracking enabled, frames sharing a tag with the previous solution are refined with Levenberg-Marquardt
+    starting from that solution, which also picks the single tag pose consistent with the history. The global solver
+    is used when nothing is tracked or the refined reprojection error exceeds solver_tracking_max_error. Tracking only
+    starts from unambiguous (multi-tag or tracked) solutions.
+    """
+    REFINE_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 10, 1e-6)
+
+    _layout_index: Union[TagLayoutIndex, None] = None
+    _layout_version: int = -1
+    _last_rvec: Union[np.typing.NDArray[np.float64], None] = None
+    _last_tvec: Union[np.typing.NDArray[np.float64], None] = None
+    _last_tag_ids: Set[int] = set()
+    _tracking_version: int = -1
+
+    def _get_layout_index(self, config_store: ConfigStore) -> TagLayoutIndex:
+        # Recompile only when the layout or tag size changes
+        layout_version = config_store.field_version('tag_layout', 'tag_size_m')
+        if self._layout_index is None or layout_version != self._layout_version:
+            self._layout_index = TagLayoutIndex(config_store.remote_config.tag_layout,
+                                                config_store.remote_config.tag_size_m)
+            self._layout_version = layout_version
+        return self._layout_index
+
     def solve_camera_pose(self, image_observations: List[TagImageObservation], config_store: ConfigStore) -> Union[CameraPoseObservation, None]:
-        # Exit if no tag layout available
-        if config_store.remote_config.tag_layout is None:
+        # Exit if no tag layout or calibration available
+        if config_store.remote_config.tag_layout is None or not config_store.local_config.has_calibration:
             return None
 
         # Exit if no observations available
         if len(image_observations) == 0:
+            self._last_rvec = None
             return None
 
-        # Create set of object and image points
+        # Gather object and image points for tags in the layout
         tag_size = config_store.remote_config.tag_size_m
-        object_points = []
-        image_points = []
-        tag_ids = []
-        tag_poses = []
-        for observation in image_observations:
-            tag_pose = None
-            for tag_data in config_store.remote_config.tag_layout['tags']:
-                if tag_data['ID'] == observation.tag_id:
-                    tag_pose = Pose3d(
-                        Translation3d(
-                            tag_data['pose']['translation']['x'],
-                            tag_data['pose']['translation']['y'],
-                            tag_data['pose']['translation']['z']
-                        ),
-                        Rotation3d(Quaternion(
-                            tag_data['pose']['rotation']['quaternion']['W'],
-                            tag_data['pose']['rotation']['quaternion']['X'],
-                            tag_data['pose']['rotation']['quaternion']['Y'],
-                            tag_data['pose']['rotation']['quaternion']['Z']
-                        )))
-            if tag_pose is not None:
-                # Add object points by transforming from the tag center
-                corner_0 = tag_pose + Transform3d(Translation3d(0, tag_size / 2.0, -tag_size / 2.0), Rotation3d())
-                corner_1 = tag_pose + Transform3d(Translation3d(0, -tag_size / 2.0, -tag_size / 2.0), Rotation3d())
-                corner_2 = tag_pose + Transform3d(Translation3d(0, -tag_size / 2.0, tag_size / 2.0), Rotation3d())
-                corner_3 = tag_pose + Transform3d(Translation3d(0, tag_size / 2.0, tag_size / 2.0), Rotation3d())
-                object_points += [
-                    wpiLibTranslationToOpenCV(corner_0.translation()),
-                    wpiLibTranslationToOpenCV(corner_1.translation()),
-                    wpiLibTranslationToOpenCV(corner_2.translation()),
-                    wpiLibTranslationToOpenCV(corner_3.translation())
-                ]
-
-                # Add image points from observation
-                image_points += [
-                    [observation.corners[0][0][0], observation.corners[0][0][1]],
-                    [observation.corners[0][1][0], observation.corners[0][1][1]],
-                    [observation.corners[0][2][0], observation.corners[0][2][1]],
-                    [observation.corners[0][3][0], observation.corners[0][3][1]]
-                ]
-
-                # Add tag ID and pose
-                tag_ids.append(observation.tag_id)
-                tag_poses.append(tag_pose)
+        layout_index = self._get_layout_index(config_store)
+        observed_ids = np.array([observation.tag_id for observation in image_observations], dtype=np.int64)
+        known = layout_index.contains(observed_ids)
+        tag_ids = [int(tag_id) for tag_id in observed_ids[known]]
+        if len(tag_ids) == 0:
+            self._last_rvec = None
+            return None
+        object_points = layout_index.object_points(observed_ids[known])
+
+        # Undistort all corners at once and solve in ideal pinhole coordinates
+        undistorter: Undistorter = config_store.local_config.undistorter
+        image_points = undistorter.undistort_points(np.concatenate([
+            observation.corners.reshape(4, 2) for observation, is_known in zip(image_observations, known) if is_known]))
+
+        # Refine the previous solution when it shares a tag with this frame
+        if config_store.remote_config.solver_tracking:
+            tracked = self._solve_tracked(object_points, image_points, tag_ids, undistorter, config_store)
+            if tracked is not None:
+                return tracked
+        else:
+            self._last_rvec = None
 
         # Single tag, return two poses
         if len(tag_ids) == 1:
@@ -79,15 +90,14 @@ class MultiTargetCameraPoseEstimator(CameraPoseEstimator):
                                       [tag_size / 2.0, -tag_size / 2.0, 0.0],
                                       [-tag_size / 2.0, -tag_size / 2.0, 0.0]])
             try:
-                _, rvecs, tvecs, errors = cv2.solvePnPGeneric(object_points, np.array(image_points),
-                                                              config_store.local_config.camera_matrix,
-                                                              config_store.local_config.distortion_coefficients,
+                _, rvecs, tvecs, errors = cv2.solvePnPGeneric(object_points, image_points,
+                                                              undistorter.camera_matrix, None,
                                                               flags=cv2.SOLVEPNP_IPPE_SQUARE)
             except:
                 return None
 
             # Calculate WPILib camera poses
-            field_to_tag_pose = tag_poses[0]
+            field_to_tag_pose = layout_index.tag_poses[tag_ids[0]]
             camera_to_tag_pose_0 = openCVPoseToWPILib(tvecs[0], rvecs[0])
             camera_to_tag_pose_1 = openCVPoseToWPILib(tvecs[1], rvecs[1])
             camera_to_tag_0 = Transform3d(camera_to_tag_pose_0.translation(), camera_to_tag_pose_0.rotation())
@@ -105,18 +115,44 @@ class MultiTargetCameraPoseEstimator(CameraPoseEstimator):
         else:
             # Run SolvePNP with all tags
             try:
-                _, rvecs, tvecs, errors = cv2.solvePnPGeneric(np.array(object_points), np.array(image_points),
-                                                              config_store.local_config.camera_matrix,
-                                                              config_store.local_config.distortion_coefficients,
+                _, rvecs, tvecs, errors = cv2.solvePnPGeneric(object_points, image_points,
+                                                              undistorter.camera_matrix, None,
                                                               flags=cv2.SOLVEPNP_SQPNP)
             except:
                 return None
 
-            # Calculate WPILib camera pose
-            camera_to_field_pose = openCVPoseToWPILib(tvecs[0], rvecs[0])
-            camera_to_field = Transform3d(camera_to_field_pose.translation(), camera_to_field_pose.rotation())
-            field_to_camera = camera_to_field.inverse()
-            field_to_camera_pose = Pose3d(field_to_camera.translation(), field_to_camera.rotation())
+            self._last_rvec, self._last_tvec, self._last_tag_ids = rvecs[0], tvecs[0], set(tag_ids)
 
             # Return result
-            return CameraPoseObservation(field_to_camera_pose, errors[0][0], None, None, tag_ids)
+            return CameraPoseObservation(_get_field_to_camera_pose(rvecs[0], tvecs[0]), errors[0][0], None, None,
+                                         tag_ids)
+
+    def _solve_tracked(self, object_points: np.typing.NDArray[np.float64],
+                       image_points: np.typing.NDArray[np.float64], tag_ids: List[int], undistorter: Undistorter,
+                       config_store: ConfigStore) -> Union[CameraPoseObservation, None]:
+        # Drop the history when the layout or calibration changes
+        tracking_version = config_store.field_version('tag_layout', 'tag_size_m', 'undistorter')
+        if tracking_version != self._tracking_version:
+            self._last_rvec = None
+            self._tracking_version = tracking_version
+
+        if self._last_rvec is None or self._last_tag_ids.isdisjoint(tag_ids):
+            self._last_rvec = None
+            return None
+
+        try:
+            rvec, tvec = cv2.solvePnPRefineLM(object_points, image_points, undistorter.camera_matrix, None,
+                                              self._last_rvec.copy(), self._last_tvec.copy(), self.REFINE_CRITERIA)
+            projected, _ = cv2.projectPoints(object_points, rvec, tvec, undistorter.camera_matrix, None)
+        except:
+            self._last_rvec = None
+            return None
+
+        # Same RMS reprojection error as solvePnPGeneric
+        error = float(np.sqrt(np.sum((projected.reshape(-1, 2) - image_points) ** 2) / (2 * len(image_points))))
+        if error > config_store.remote_config.solver_tracking_max_error:
+            self._last_rvec = None
+            return None
+
+        self._last_rvec, self._last_tvec, self._last_tag_ids = rvec, tvec, set(tag_ids)
+        return CameraPoseObservation(_get_field_to_camera_pose(rvec, tvec), error, None, None, tag_ids)
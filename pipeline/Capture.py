@@ -1,90 +1,343 @@
-import dataclasses
-import sys
+import collections
 import time
-from typing import Tuple
+from typing import Deque, Dict, Tuple, Union
 
 import cv2
 import numpy as np
 from config.config import ConfigStore
+from vision_types import CapturedFrame
+
+from pipeline.frame_bus import FrameBusReader
+from pipeline.frame_log import RecordedFrame, RecordingReader, apply_config_snapshot
+from pipeline.v4l2_controls import (V4L2_CID_EXPOSURE_ABSOLUTE, V4L2_CID_EXPOSURE_AUTO, V4L2_CID_GAIN,
+                                    V4L2Controls)
 
 
 class Capture:
     """Interface for receiving camera frames."""
 
-    def get_frame(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat]:
-        """Return the next frame from the camera."""
+    # Remote config fields that require restarting the capture session
+    SESSION_CONFIG_FIELDS = ('camera_id', 'camera_resolution_width', 'camera_resolution_height', 'camera_grayscale')
+    # Remote config fields that can be applied to a running session
+    CONTROL_CONFIG_FIELDS = ('camera_auto_exposure', 'camera_exposure', 'camera_gain')
+
+    _last_session_version: int = 0
+    _last_control_version: int = 0
+
+    # Seconds spent retrieving and converting the last frame, included in the get_frame call
+    last_decode_time: float = 0.0
+    # Frames lost between the previous and the last frame, such as frames dropped by the sink
+    last_dropped_frames: int = 0
+    # Set once a finite source, such as a recording, has no more frames
+    finished: bool = False
+
+    # Number of recent frame intervals the expected interval is estimated from
+    FRAME_INTERVAL_WINDOW = 5
+
+    _last_sensor_time: Union[float, None] = None
+    _frame_intervals: Union[Deque[float], None] = None
+
+    def open(self, config_store: ConfigStore) -> None:
+        """Start the capture session ahead of the first get_frame call, if supported."""
+        pass
+
+    def get_frame(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat, float]:
+        """Return the next frame from the camera and its capture time in time.monotonic() seconds."""
         raise NotImplementedError
 
-    @classmethod
-    def _config_changed(cls, config_a: ConfigStore, config_b: ConfigStore) -> bool:
-        if config_a is None and config_b is None:
-            return False
-        if config_a is None or config_b is None:
-            return True
+    def is_current(self, image: cv2.Mat) -> bool:
+        """Return whether an image returned by get_frame is unchanged, checked after using it.
 
-        remote_a = config_a.remote_config
-        remote_b = config_b.remote_config
+        Only images that are views into memory shared with another process can be overwritten while in use.
+        """
+        return True
 
-        return remote_a.camera_id != remote_b.camera_id or remote_a.camera_resolution_width != remote_b.camera_resolution_width or remote_a.camera_resolution_height != remote_b.camera_resolution_height or remote_a.camera_auto_exposure != remote_b.camera_auto_exposure or remote_a.camera_exposure != remote_b.camera_exposure or remote_a.camera_gain != remote_b.camera_gain
+    def _session_config_changed(self, config_store: ConfigStore) -> bool:
+        """Return whether the session config changed since the last call."""
+        config_version = config_store.field_version(*self.SESSION_CONFIG_FIELDS)
+        changed = config_version != self._last_session_version
+        self._last_session_version = config_version
+        return changed
+
+    def _update_dropped_frames(self, sensor_time: Union[float, None]) -> None:
+        """Estimate last_dropped_frames from the gap to the previous sensor timestamp, None starts over."""
+        self.last_dropped_frames = 0
+        if sensor_time is None or self._last_sensor_time is None or self._frame_intervals is None:
+            self._last_sensor_time = sensor_time
+            self._frame_intervals = collections.deque(maxlen=self.FRAME_INTERVAL_WINDOW)
+            return
+
+        # Drops are rare, so the median interval follows frame rate changes without counting gaps
+        interval = sensor_time - self._last_sensor_time
+        self._last_sensor_time = sensor_time
+        if len(self._frame_intervals) >= 3:
+            expected_interval = float(np.median(self._frame_intervals))
+            if expected_interval > 0:
+                self.last_dropped_frames = max(0, round(interval / expected_interval) - 1)
+        self._frame_intervals.append(interval)
+
+    def _controls_changed(self, config_store: ConfigStore) -> bool:
+        """Return whether the camera controls changed since the last call."""
+        config_version = config_store.field_version(*self.CONTROL_CONFIG_FIELDS)
+        changed = config_version != self._last_control_version
+        self._last_control_version = config_version
+        return changed
 
 
 class DefaultCapture(Capture):
     """Read from camera with default OpenCV config."""
     _video = None
-    _last_config: ConfigStore
 
-    def get_frame(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat]:
-        if self._video is not None and self._config_changed(self._last_config, config_store):
+    def get_frame(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat, float]:
+        if self._session_config_changed(config_store) and self._video is not None:
             print('Restarting capture session')
             self._video.release()
             self._video = None
 
         if self._video is None:
             self._video = cv2.VideoCapture(config_store.remote_config.camera_id)
+            self._update_dropped_frames(None)
             self._video.set(cv2.CAP_PROP_FRAME_WIDTH, config_store.remote_config.camera_resolution_width)
             self._video.set(cv2.CAP_PROP_FRAME_HEIGHT, config_store.remote_config.camera_resolution_height)
-            self._video.set(cv2.CAP_PROP_AUTO_EXPOSURE, config_store.remote_config.camera_auto_exposure)
-            self._video.set(cv2.CAP_PROP_EXPOSURE, config_store.remote_config.camera_exposure)
-            self._video.set(cv2.CAP_PROP_GAIN, config_store.remote_config.camera_gain)
             self._video.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter.fourcc('M', 'J', 'P', 'G'))
-
-        self._last_config = config_store
+            self._controls_changed(config_store)
+            self._set_controls(config_store)
+        elif self._controls_changed(config_store):
+            self._set_controls(config_store)
 
         retval, image = self._video.read()
-        return retval, image
+        timestamp = time.monotonic()
+
+        # The V4L2 backend reports the driver's CLOCK_MONOTONIC buffer timestamp
+        buffer_timestamp = None
+        if self._video.getBackendName() == 'V4L2':
+            buffer_timestamp = self._video.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+            if not timestamp - 1.0 < buffer_timestamp <= timestamp:
+                buffer_timestamp = None
+        if buffer_timestamp is not None:
+            timestamp = buffer_timestamp
+        # Without a buffer timestamp drops can't be told, start over so the last count is not repeated
+        self._update_dropped_frames(buffer_timestamp)
+
+        if retval and config_store.remote_config.camera_grayscale:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return retval, image, timestamp
+
+    def _set_controls(self, config_store: ConfigStore) -> None:
+        self._video.set(cv2.CAP_PROP_AUTO_EXPOSURE, config_store.remote_config.camera_auto_exposure)
+        self._video.set(cv2.CAP_PROP_EXPOSURE, config_store.remote_config.camera_exposure)
+        self._video.set(cv2.CAP_PROP_GAIN, config_store.remote_config.camera_gain)
 
 
 class GStreamerCapture(Capture):
-    """Read from camera with GStreamer."""
+    """Read from camera with GStreamer.
+
+    In grayscale mode only the luma plane of the decoded JPEG is handed to OpenCV, skipping the BGR conversion.
+
+    Frames are timestamped from the buffer PTS set by v4l2src. PTS is in pipeline running time, which is the
+    monotonic system clock minus the unknown pipeline base time. The base time is estimated as the minimum
+    difference between arrival time and PTS, so queueing and decode delays that vary between frames are removed.
+
+    Frames dropped by the appsink or the driver are counted from gaps between PTS values.
+
+    Exposure and gain changes are written to the running device with V4L2 ioctls. A failed session is reopened in
+    process with an exponential backoff.
+    """
+    RECONNECT_MIN_DELAY_S = 0.5
+    RECONNECT_MAX_DELAY_S = 8.0
+
     _video = None
-    _last_config: ConfigStore
+    _controls: Union[V4L2Controls, None] = None
+    _pts_offset: Union[float, None] = None
+    _reconnect_delay: float = RECONNECT_MIN_DELAY_S
+    _reconnect_time: float = 0.0
 
-    def get_frame(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat]:
-        if self._video is not None and self._config_changed(self._last_config, config_store):
-            print('Config changed, stopping capture session')
-            self._video.release()
-            self._video = None
-            time.sleep(2)
+    def open(self, config_store: ConfigStore) -> None:
+        self._session_config_changed(config_store)
+        self._controls_changed(config_store)
+        if self._video is None and config_store.remote_config.camera_id != -1:
+            self._start_session(config_store)
+
+    def get_frame(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat, float]:
+        if self._session_config_changed(config_store) and self._video is not None:
+            print('Camera config changed, restarting capture session')
+            self._stop_session()
+            self._reconnect_delay = self.RECONNECT_MIN_DELAY_S
+            self._reconnect_time = 0.0
+
+        # Exposure and gain are set on the running device, without restarting the session
+        if self._controls_changed(config_store) and self._video is not None:
+            if self._controls is None or not self._set_controls(config_store):
+                print('Failed to set camera controls, restarting capture session')
+                self._stop_session()
 
         if self._video is None:
             if config_store.remote_config.camera_id == -1:
                 print('No camera ID, waiting to start capture session')
-            else:
-                print('Starting capture session')
-                self._video = cv2.VideoCapture('v4l2src device=/dev/video' + str(config_store.remote_config.camera_id) + ' extra_controls=\"c,exposure_auto=' + str(config_store.remote_config.camera_auto_exposure) + ',exposure_absolute=' + str(
-                    config_store.remote_config.camera_exposure) + ',gain=' + str(config_store.remote_config.camera_gain) + ',sharpness=0,brightness=0\" ! image/jpeg,format=MJPG,width=' + str(config_store.remote_config.camera_resolution_width) + ',height=' + str(config_store.remote_config.camera_resolution_height) + ' ! jpegdec ! video/x-raw ! appsink drop=1', cv2.CAP_GSTREAMER)
-                print('Capture session ready')
+            elif time.monotonic() >= self._reconnect_time:
+                self._start_session(config_store)
+
+        if self._video is None:
+            return False, cv2.Mat(np.ndarray([])), 0.0
 
-        self._last_config = ConfigStore(dataclasses.replace(config_store.local_config),
-                                        dataclasses.replace(config_store.remote_config))
+        retval = self._video.grab()
+        timestamp = time.monotonic()
+        if retval:
+            timestamp = self._get_buffer_timestamp(timestamp)
+            decode_start = time.perf_counter()
+            retval, image = self._video.retrieve()
+            self.last_decode_time = time.perf_counter() - decode_start
+        if not retval:
+            print('Capture session failed, reconnecting in ' + str(self._reconnect_delay) + ' s')
+            self._stop_session()
+            self._schedule_reconnect()
+            return False, cv2.Mat(np.ndarray([])), 0.0
+        self._reconnect_delay = self.RECONNECT_MIN_DELAY_S
+        return retval, image, timestamp
 
+    def _start_session(self, config_store: ConfigStore) -> None:
+        print('Starting capture session')
+        device = '/dev/video' + str(config_store.remote_config.camera_id)
+        self._pts_offset = None
+        self._update_dropped_frames(None)
+        self._video = cv2.VideoCapture('v4l2src device=' + device + ' extra_controls=\"c,exposure_auto=' + str(config_store.remote_config.camera_auto_exposure) + ',exposure_absolute=' + str(
+            config_store.remote_config.camera_exposure) + ',gain=' + str(config_store.remote_config.camera_gain) + ',sharpness=0,brightness=0\" ! image/jpeg,format=MJPG,width=' + str(config_store.remote_config.camera_resolution_width) + ',height=' + str(config_store.remote_config.camera_resolution_height) + ' ! jpegdec ! ' + self._get_output_caps(config_store) + ' ! appsink drop=1', cv2.CAP_GSTREAMER)
+        if not self._video.isOpened():
+            print('Failed to open capture session, retrying in ' + str(self._reconnect_delay) + ' s')
+            self._stop_session()
+            self._schedule_reconnect()
+            return
+
+        # Controls are set through a second handle to the device, the session applied the current values on start
+        try:
+            self._controls = V4L2Controls(device)
+        except OSError as e:
+            print('Failed to open camera controls, control changes will restart the session:', e)
+        print('Capture session ready')
+
+    def _stop_session(self) -> None:
         if self._video is not None:
-            retval, image = self._video.read()
-            if not retval:
-                print('Capture session failed, restarting')
-                self._video.release()
-                self._video = None  # Force reconnect
-                sys.exit(1)
-            return retval, image
-        else:
-            return False, cv2.Mat(np.ndarray([]))
\ No newline at end of file
+            self._video.release()
+            self._video = None
+        if self._controls is not None:
+            self._controls.close()
+            self._controls = None
+
+    def _schedule_reconnect(self) -> None:
+        self._reconnect_time = time.monotonic() + self._reconnect_delay
+        self._reconnect_delay = min(self._reconnect_delay * 2, self.RECONNECT_MAX_DELAY_S)
+
+    def _set_controls(self, config_store: ConfigStore) -> bool:
+        # Set the exposure mode first, the driver rejects an absolute exposure while auto exposure is enabled
+        success = self._controls.set_control(V4L2_CID_EXPOSURE_AUTO, config_store.remote_config.camera_auto_exposure)
+        if config_store.remote_config.camera_auto_exposure == 1:
+            success = self._controls.set_control(V4L2_CID_EXPOSURE_ABSOLUTE,
+                                                 config_store.remote_config.camera_exposure) and success
+        success = self._controls.set_control(V4L2_CID_GAIN, config_store.remote_config.camera_gain) and success
+        return success
+
+    def _get_buffer_timestamp(self, arrival_time: float) -> float:
+        pts = self._video.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+        if pts <= 0:
+            self._update_dropped_frames(None)
+            return arrival_time
+        self._update_dropped_frames(pts)
+        if self._pts_offset is None or arrival_time - pts < self._pts_offset:
+            self._pts_offset = arrival_time - pts
+        return self._pts_offset + pts
+
+    @staticmethod
+    def _get_output_caps(config_store: ConfigStore) -> str:
+        if config_store.remote_config.camera_grayscale:
+            return 'videoconvert ! video/x-raw,format=GRAY8'
+        return 'video/x-raw'
+
+
+class ReplayCapture(Capture):
+    """Read frames from a recording made by FrameRecorder, applying its config snapshots.
+
+    Frames are replayed at the recorded frame rate, or as fast as the pipeline takes them.
+    """
+
+    def __init__(self, path: str, realtime: bool = True) -> None:
+        self._path = path
+        self._recording = iter(RecordingReader(path))
+        self._realtime = realtime
+        self._start_time: Union[float, None] = None
+        self._first_timestamp = 0.0
+
+    def apply_initial_config(self, config_store: ConfigStore) -> None:
+        """Apply the config snapshot at the start of the recording, such as its calibration."""
+        for record in RecordingReader(self._path):
+            if not isinstance(record, RecordedFrame):
+                apply_config_snapshot(config_store, record)
+            break
+
+    def get_frame(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat, float]:
+        for record in self._recording:
+            if not isinstance(record, RecordedFrame):
+                apply_config_snapshot(config_store, record)
+                continue
+
+            if self._start_time is None:
+                self._start_time = time.monotonic()
+                self._first_timestamp = record.timestamp
+            if not self._realtime:
+                return True, record.image, time.monotonic()
+
+            # Wait until the frame's time relative to the start of the recording
+            timestamp = self._start_time + record.timestamp - self._first_timestamp
+            delay = timestamp - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            return True, record.image, timestamp
+
+        if not self.finished:
+            print('Replay finished')
+            self.finished = True
+        return False, cv2.Mat(np.ndarray([])), 0.0
+
+
+class SharedMemoryCapture(Capture):
+    """Read frames that another Polaris process publishes to a frame bus, without opening the camera.
+
+    Frames are views into the bus and are not copied. The publishing process owns the camera and its config, so the
+    camera settings of this process only need to match its resolution for the calibration.
+    """
+    POLL_INTERVAL_S = 0.001
+    TIMEOUT_S = 1.0
+    # Bus frames remembered for is_current, more than the pipeline holds at once
+    MAX_FRAMES_IN_USE = 16
+
+    def __init__(self, name: str) -> None:
+        self._reader = FrameBusReader(name)
+        self._last_sequence = 0
+        self._receiving = False
+        # Bus frames by the id of their image, which they keep alive. Only the capture thread adds and removes frames.
+        self._frames: Dict[int, CapturedFrame] = {}
+
+    def get_frame(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat, float]:
+        deadline = time.monotonic() + self.TIMEOUT_S
+        while time.monotonic() < deadline:
+            frame = self._reader.get_frame(self._last_sequence)
+            if frame is not None:
+                self.last_dropped_frames = max(0, frame.sequence - self._last_sequence - 1) if self._receiving else 0
+                self._last_sequence = frame.sequence
+                self._receiving = True
+                self._frames[id(frame.image)] = frame
+                if len(self._frames) > self.MAX_FRAMES_IN_USE:
+                    del self._frames[next(iter(self._frames))]
+                return True, frame.image, frame.timestamp
+            time.sleep(self.POLL_INTERVAL_S)
+
+        # A publisher that was killed leaves its segment unlinked but not closed, attach to its replacement
+        if self._receiving:
+            print('No frames from the frame bus, waiting for the publisher')
+            self._receiving = False
+        self._reader.close()
+        return False, cv2.Mat(np.ndarray([])), 0.0
+
+    def is_current(self, image: cv2.Mat) -> bool:
+        # Frames no longer remembered are assumed to be overwritten
+        frame = self._frames.get(id(image))
+        return frame is not None and frame.image is image and self._reader.is_current(frame)
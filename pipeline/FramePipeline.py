@@ -0,0 +1,437 @@
+import os
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, List, Union
+
+import cv2
+
+from config.config import ConfigStore
+from config.ConfigSource import ConfigSource
+from output.FrameRecorder import FrameRecorder
+from output.OutputPublisher import OutputPublisher
+from output.overlay_util import overlay_image_observation
+from output.StreamServer import StreamServer
+from vision_types import CapturedFrame, TagImageObservation, TagPoseObservation
+
+from pipeline.CameraPoseEstimator import CameraPoseEstimator
+from pipeline.Capture import Capture
+from pipeline.frame_bus import FrameBusWriter
+from pipeline.FusedPoseEstimator import CameraTagObservations, FusedPoseEstimator
+from pipeline.metrics import PipelineMetrics, StartupTimer
+from pipeline.PoseEstimator import PoseEstimator
+from pipeline.TagDetector import TagDetector
+
+
+class LatestQueue:
+    """Single-slot hand-off between pipeline stages where the newest item wins.
+
+    Items are tagged with the frame sequence number. Putting an item replaces any item not yet taken, and items
+    older than the last one accepted are discarded, so consumers always see frames in capture order. A lossless
+    queue instead blocks the producer until the previous item is taken. Once closed, get returns the item left in
+    the queue and then None.
+    """
+
+    def __init__(self, lossless: bool = False) -> None:
+        self._lossless = lossless
+        self._condition = threading.Condition()
+        self._item: Any = None
+        self._has_item = False
+        self._last_sequence = -1
+        self._closed = False
+        self.dropped = 0
+
+    def put(self, sequence: int, item: Any) -> None:
+        with self._condition:
+            if sequence <= self._last_sequence:
+                self.dropped += 1
+                return
+            while self._lossless and self._has_item:
+                self._condition.wait()
+            if self._has_item:
+                self.dropped += 1
+            self._item = item
+            self._has_item = True
+            self._last_sequence = sequence
+            self._condition.notify_all()
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def get(self) -> Any:
+        with self._condition:
+            while not self._has_item:
+                if self._closed:
+                    return None
+                self._condition.wait()
+            item = self._item
+            self._item = None
+            self._has_item = False
+            self._condition.notify_all()
+            return item
+
+
+class FramePipeline:
+    """Runs capture, detection, pose solving, publishing and streaming as separate worker threads.
+
+    OpenCV releases the GIL while detecting and solving, so stages overlap across cores. Multiple detector workers
+    each take the newest captured frame when they become free and results are handed off in capture order.
+
+    In lossless mode, used to replay recordings deterministically, every frame passes through a single detector
+    worker and stages wait for each other instead of dropping frames.
+
+    Frames are numbered from capture on, counting frames lost before capture, and every stage counts the frames it
+    dropped, so gaps in the published sequence numbers can be traced to a stage.
+
+    With a fusion input, detections are handed to a FusionPipeline instead of being solved and published per camera.
+    With a tag pose estimator and output_tag_poses enabled, both poses of every tag are also solved and published.
+    With a frame bus, the capture stage also publishes every frame to shared memory for other processes.
+    """
+
+    def __init__(self, config_store: ConfigStore, config_sources: List[ConfigSource], capture: Capture,
+                 tag_detector_factory: Callable[[], TagDetector], pose_estimator: CameraPoseEstimator,
+                 output_publisher: OutputPublisher, stream_server: StreamServer,
+                 frame_recorder: Union[FrameRecorder, None] = None, lossless: bool = False,
+                 startup_timer: Union[StartupTimer, None] = None,
+                 fusion_input: Union[Callable[[CapturedFrame, List[TagImageObservation]], None], None] = None,
+                 frame_bus: Union[FrameBusWriter, None] = None,
+                 tag_pose_estimator: Union[PoseEstimator, None] = None) -> None:
+        self.metrics = PipelineMetrics(
+            stages=PipelineMetrics.STAGES + (('frame_bus',) if frame_bus is not None else ()))
+        self._startup_timer = startup_timer
+        self._config_store = config_store
+        self._config_sources = config_sources
+        self._capture = capture
+        self._tag_detector_factory = tag_detector_factory
+        self._pose_estimator = pose_estimator
+        self._output_publisher = output_publisher
+        self._stream_server = stream_server
+        self._frame_recorder = frame_recorder
+        self._fusion_input = fusion_input
+        self._frame_bus = frame_bus
+        self._tag_pose_estimator = tag_pose_estimator
+
+        self._lossless = lossless
+        self._capture_queue = LatestQueue(lossless)
+        self._solve_queue = LatestQueue(lossless)
+        self._publish_queue = LatestQueue(lossless)
+        self._stream_queue = LatestQueue()
+        self._record_queue = LatestQueue()
+        self._capture_dropped = 0
+        # Frames from a frame bus that were overwritten while detected, counted as lost before capture
+        self._overwritten_frames = 0
+        self._overwritten_lock = threading.Lock()
+        self._published_frames = 0
+        self._running_detectors = 0
+        self._detectors_lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> None:
+        self._start_stage('capture', self._capture_loop)
+        detector_workers = 1 if self._lossless else max(1, self._config_store.local_config.detector_workers)
+        self._running_detectors = detector_workers
+        for index in range(detector_workers):
+            self._start_stage('detect-' + str(index), self._detect_loop, self._tag_detector_factory())
+        self._start_stage('solve', self._solve_loop)
+        self._start_stage('publish', self._publish_loop)
+        self._start_stage('stream', self._stream_loop)
+        if self._frame_recorder is not None:
+            self._start_stage('record', self._record_loop)
+
+    def join(self) -> None:
+        """Wait until the capture has no more frames, such as at the end of a replay, and every stage drained."""
+        for thread in self._threads:
+            thread.join()
+
+    def print_summary(self) -> None:
+        print('Published', self._published_frames, 'frames')
+        for stage, stage_summary in self.metrics.summary().items():
+            print(stage, 'p50', round(stage_summary['p50_ms'], 2), 'ms, p95', round(stage_summary['p95_ms'], 2),
+                  'ms, p99', round(stage_summary['p99_ms'], 2), 'ms over', stage_summary['count'], 'frames')
+        print('Dropped', self.drop_counts())
+
+    def drop_counts(self) -> Dict[str, int]:
+        """Return the number of frames lost before capture and dropped before each stage since the start."""
+        drop_counts = {'capture': self._capture_dropped + self._overwritten_frames,
+                       'detect': self._capture_queue.dropped, 'solve': self._solve_queue.dropped,
+                       'publish': self._publish_queue.dropped, 'stream': self._stream_queue.dropped}
+        if self._frame_recorder is not None:
+            drop_counts['record'] = self._record_queue.dropped
+        return drop_counts
+
+    def _start_stage(self, name: str, target: Callable[..., None], *args: Any) -> None:
+        thread = threading.Thread(target=self._run_stage, name=name, daemon=True, args=(target,) + args)
+        self._threads.append(thread)
+        thread.start()
+
+    @staticmethod
+    def _run_stage(target: Callable[..., None], *args: Any) -> None:
+        # Exit the whole process if a stage dies so the service is restarted, stages only return once drained
+        try:
+            target(*args)
+            return
+        except BaseException:
+            traceback.print_exc()
+        os._exit(1)
+
+    def _capture_loop(self) -> None:
+        sequence = 0
+        while True:
+            for config_source in self._config_sources:
+                config_source.update(self._config_store)
+            capture_start = time.perf_counter()
+            success, image, timestamp = self._capture.get_frame(self._config_store)
+            capture_time = time.perf_counter() - capture_start
+
+            if not success:
+                if self._capture.finished:
+                    break
+                time.sleep(0.5)
+                continue
+            if self._startup_timer is not None:
+                self._startup_timer.mark('first_frame')
+            self.metrics.record('capture_wait', capture_time - self._capture.last_decode_time)
+            self.metrics.record('decode', self._capture.last_decode_time)
+
+            # Lost frames keep their sequence numbers, so the robot sees the gap
+            self._capture_dropped += self._capture.last_dropped_frames
+            sequence += 1 + self._capture.last_dropped_frames
+            frame = CapturedFrame(sequence, timestamp, image)
+            if self._frame_bus is not None:
+                bus_start = time.perf_counter()
+                self._frame_bus.write(sequence, timestamp, image)
+                self.metrics.record('frame_bus', time.perf_counter() - bus_start)
+            self._capture_queue.put(sequence, frame)
+            if self._frame_recorder is not None:
+                self._record_queue.put(sequence, frame)
+
+        # Let the stages finish the frames in flight and stop
+        self._capture_queue.close()
+        self._record_queue.close()
+
+    def _detect_loop(self, tag_detector: TagDetector) -> None:
+        try:
+            while True:
+                frame: Union[CapturedFrame, None] = self._capture_queue.get()
+                if frame is None:
+                    break
+                detect_start = time.perf_counter()
+                image_observations = tag_detector.detect_tags(frame.image, self._config_store)
+                self.metrics.record('detect', time.perf_counter() - detect_start)
+                if not self._capture.is_current(frame.image):
+                    with self._overwritten_lock:
+                        self._overwritten_frames += 1
+                    continue
+                self._solve_queue.put(frame.sequence, (frame, image_observations))
+        finally:
+            tag_detector.close()
+
+        # The last detector to stop closes the solve queue
+        with self._detectors_lock:
+            self._running_detectors -= 1
+            if self._running_detectors == 0:
+                self._solve_queue.close()
+
+    def _solve_loop(self) -> None:
+        while True:
+            item = self._solve_queue.get()
+            if item is None:
+                self._publish_queue.close()
+                return
+            frame, image_observations = item
+            if self._fusion_input is not None:
+                self._fusion_input(frame, image_observations)
+            solve_start = time.perf_counter()
+            pose_observation = None
+            if self._fusion_input is None:
+                pose_observation = self._pose_estimator.solve_camera_pose(image_observations, self._config_store)
+            tag_pose_observations: Union[List[Union[TagPoseObservation, None]], None] = None
+            if self._tag_pose_estimator is not None and self._config_store.remote_config.output_tag_poses:
+                tag_pose_observations = self._tag_pose_estimator.solve_tag_poses(image_observations,
+                                                                                  self._config_store)
+            self.metrics.record('solve', time.perf_counter() - solve_start)
+            self._publish_queue.put(frame.sequence,
+                                    (frame, image_observations, pose_observation, tag_pose_observations))
+
+    def _publish_loop(self) -> None:
+        frame_count = 0
+        last_print = 0
+        while True:
+            item = self._publish_queue.get()
+            if item is None:
+                self._stream_queue.close()
+                return
+            frame, image_observations, pose_observation, tag_pose_observations = item
+            self._published_frames += 1
+
+            fps: Union[int, None] = None
+            frame_count += 1
+            if time.time() - last_print > 1:
+                last_print = time.time()
+                fps = frame_count
+                print('Running at', frame_count, 'fps')
+                frame_count = 0
+
+            publish_start = time.perf_counter()
+            if self._fusion_input is None:
+                self._output_publisher.send(self._config_store, frame.sequence, frame.timestamp, pose_observation,
+                                            fps)
+            elif fps is not None:
+                self._output_publisher.send_fps(self._config_store, fps)
+            if tag_pose_observations is not None:
+                self._output_publisher.send_tag_poses(self._config_store, frame.sequence, frame.timestamp,
+                                                      image_observations, tag_pose_observations)
+            self.metrics.record('publish', time.perf_counter() - publish_start)
+
+            if self._startup_timer is not None and pose_observation is not None:
+                self._startup_timer.mark('first_observation')
+            if fps is not None:
+                if self._startup_timer is not None:
+                    self._output_publisher.send_startup_timings(self._config_store, self._startup_timer.summary())
+                metrics_summary = self.metrics.summary()
+                self._output_publisher.send_metrics(self._config_store, metrics_summary)
+                self._output_publisher.send_drop_counts(self._config_store, self.drop_counts())
+                self._stream_server.set_metrics(metrics_summary)
+            if self._stream_server.wants_frame():
+                self._stream_queue.put(frame.sequence, (frame, image_observations))
+
+    def _stream_loop(self) -> None:
+        while True:
+            item = self._stream_queue.get()
+            if item is None:
+                return
+            frame, image_observations = item
+            if not self._stream_server.wants_frame():
+                continue
+            stream_start = time.perf_counter()
+            image = frame.image
+            if len(image.shape) == 2:
+                image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+            elif self._frame_recorder is not None or not image.flags.writeable:
+                image = image.copy()  # Shared with the recorder or mapped from a recording
+            for obs in image_observations:
+                overlay_image_observation(image, obs)
+            if not self._capture.is_current(frame.image):
+                continue
+            self._stream_server.set_frame(image)
+            self.metrics.record('stream', time.perf_counter() - stream_start)
+
+    def _record_loop(self) -> None:
+        while True:
+            frame: Union[CapturedFrame, None] = self._record_queue.get()
+            if frame is None:
+                return
+            image = frame.image
+            if not image.flags.writeable:
+                # Copy views into shared memory before checking they were not overwritten
+                image = image.copy()
+                if not self._capture.is_current(frame.image):
+                    continue
+            self._frame_recorder.record(self._config_store, frame.sequence, frame.timestamp, image)
+
+
+class FusionPipeline:
+    """Solves and publishes one robot pose from the detections of all cameras of the device.
+
+    Camera pipelines hand over the detections of each frame. Detections captured within fusion_max_offset_ms of the
+    newest are solved together once every camera has delivered a frame, waiting at most fusion_max_offset_ms after
+    the first so a stalled camera does not hold back the others.
+    """
+
+    def __init__(self, config_store: ConfigStore, config_sources: List[ConfigSource], camera_configs: List[ConfigStore],
+                 pose_estimator: FusedPoseEstimator, output_publisher: OutputPublisher,
+                 startup_timer: Union[StartupTimer, None] = None) -> None:
+        self.metrics = PipelineMetrics(stages=('solve', 'publish'))
+        self._config_store = config_store
+        self._config_sources = config_sources
+        self._camera_configs = camera_configs
+        self._pose_estimator = pose_estimator
+        self._output_publisher = output_publisher
+        self._startup_timer = startup_timer
+
+        self._condition = threading.Condition()
+        self._pending: List[Union[CameraTagObservations, None]] = [None] * len(camera_configs)
+        self._first_arrival = 0.0
+        # Frames replaced before they were fused or too far apart in time to fuse
+        self._dropped = 0
+        self._thread: Union[threading.Thread, None] = None
+
+    def put(self, camera_index: int, frame: CapturedFrame, image_observations: List[TagImageObservation]) -> None:
+        """Hand over the detections of a camera frame, replacing that camera's frame if not fused yet."""
+        with self._condition:
+            if all(pending is None for pending in self._pending):
+                self._first_arrival = time.monotonic()
+            if self._pending[camera_index] is not None:
+                self._dropped += 1
+            self._pending[camera_index] = CameraTagObservations(camera_index, self._camera_configs[camera_index],
+                                                                frame.timestamp, image_observations)
+            self._condition.notify_all()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=FramePipeline._run_stage, name='fuse', daemon=True,
+                                        args=(self._fuse_loop,))
+        self._thread.start()
+
+    def join(self) -> None:
+        if self._thread is not None:
+            self._thread.join()
+
+    def _take(self) -> List[CameraTagObservations]:
+        max_offset = self._config_store.local_config.fusion_max_offset_ms / 1000.0
+        with self._condition:
+            while True:
+                pending = [camera_observations for camera_observations in self._pending
+                           if camera_observations is not None]
+                if len(pending) == len(self._pending):
+                    break
+                if len(pending) == 0:
+                    self._condition.wait()
+                    continue
+                remaining = self._first_arrival + max_offset - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            self._pending = [None] * len(self._pending)
+
+            # Frames too far behind the newest would be solved with the robot in a different place. Counted under
+            # the lock, put counts replaced frames from the camera threads.
+            newest = max(camera_observations.timestamp for camera_observations in pending)
+            aligned = [camera_observations for camera_observations in pending
+                       if newest - camera_observations.timestamp <= max_offset]
+            self._dropped += len(pending) - len(aligned)
+        return aligned
+
+    def _fuse_loop(self) -> None:
+        sequence = 0
+        frame_count = 0
+        last_print = 0
+        while True:
+            for config_source in self._config_sources:
+                config_source.update(self._config_store)
+            camera_observations = self._take()
+            sequence += 1
+
+            solve_start = time.perf_counter()
+            pose_observation = self._pose_estimator.solve_robot_pose(camera_observations, self._config_store)
+            self.metrics.record('solve', time.perf_counter() - solve_start)
+
+            fps: Union[int, None] = None
+            frame_count += 1
+            if time.time() - last_print > 1:
+                last_print = time.time()
+                fps = frame_count
+                frame_count = 0
+
+            # Published at the mean capture time of the fused frames
+            timestamp = sum(observations.timestamp for observations in camera_observations) / len(camera_observations)
+            publish_start = time.perf_counter()
+            self._output_publisher.send(self._config_store, sequence, timestamp, pose_observation, fps)
+            self.metrics.record('publish', time.perf_counter() - publish_start)
+
+            if self._startup_timer is not None and pose_observation is not None:
+                self._startup_timer.mark('first_observation')
+            if fps is not None:
+                self._output_publisher.send_metrics(self._config_store, self.metrics.summary())
+                self._output_publisher.send_drop_counts(self._config_store, {'fuse': self._dropped})
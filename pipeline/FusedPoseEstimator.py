@@ -0,0 +1,216 @@
+from dataclasses import dataclass
+from typing import Dict, List, Tuple, Union
+
+import cv2
+import numpy as np
+import numpy.typing
+from config.config import ConfigStore
+from vision_types import CameraPoseObservation, TagImageObservation
+from wpimath.geometry import Rotation3d
+
+from pipeline.CameraPoseEstimator import _get_field_to_camera_pose
+from pipeline.tag_layout import TagLayoutIndex
+from pipeline.undistortion import Undistorter
+
+# WPILib (X forward, Y left, Z up) to OpenCV (X right, Y down, Z forward) axes
+WPILIB_TO_OPENCV = np.array([[0.0, -1.0, 0.0],
+                             [0.0, 0.0, -1.0],
+                             [1.0, 0.0, 0.0]])
+
+
+@dataclass(frozen=True)
+class CameraTagObservations:
+    camera_index: int
+    config_store: ConfigStore
+    timestamp: float
+    image_observations: List[TagImageObservation]
+
+
+@dataclass(frozen=True)
+class _View:
+    camera_index: int
+    object_points: np.typing.NDArray[np.float64]
+    image_points: np.typing.NDArray[np.float64]
+    camera_matrix: np.typing.NDArray[np.float64]
+    # Robot to camera transform in OpenCV axes, as a rotation and translation vector
+    rvec: np.typing.NDArray[np.float64]
+    tvec: np.typing.NDArray[np.float64]
+
+
+def get_camera_extrinsic(robot_to_camera: List[float]) -> Tuple[np.typing.NDArray[np.float64],
+                                                                  np.typing.NDArray[np.float64]]:
+    """Convert the camera pose on the robot, [x, y, z, roll, pitch, yaw] in WPILib coordinates, to the OpenCV rvec
+    and tvec mapping robot points to camera points."""
+    x, y, z, roll, pitch, yaw = robot_to_camera
+    camera_to_robot_rotation = np.array(Rotation3d(roll, pitch, yaw).toMatrix()).T
+    rotation = WPILIB_TO_OPENCV @ camera_to_robot_rotation @ WPILIB_TO_OPENCV.T
+    translation = -WPILIB_TO_OPENCV @ camera_to_robot_rotation @ np.array([x, y, z])
+    rvec, _ = cv2.Rodrigues(rotation)
+    return rvec, translation.reshape(3, 1)
+
+
+def _invert(rvec: np.typing.NDArray[np.float64], tvec: np.typing.NDArray[np.float64]) -> Tuple[
+        np.typing.NDArray[np.float64], np.typing.NDArray[np.float64]]:
+    rotation, _ = cv2.Rodrigues(rvec)
+    inverse_rvec, _ = cv2.Rodrigues(rotation.T)
+    return inverse_rvec, -rotation.T @ tvec.reshape(3, 1)
+
+
+class FusedPoseEstimator:
+    """Solves one field to robot pose from the tags seen by all cameras at about the same time.
+
+    Each camera contributes the corners of its tags through its pose on the robot (robot_to_camera), and the robot
+    pose minimizing the reprojection error over all corners is found with Levenberg-Marquardt. It starts from the best
+    of the per-camera solutions and the previous fused pose, so one tag in each of two cameras already gives a single
+    well-conditioned pose. Two poses are only returned when a single tag is seen by a single camera.
+    """
+    MAX_ITERATIONS = 10
+    EPSILON = 1e-6
+
+    _layout_index: Union[TagLayoutIndex, None] = None
+    _layout_version: int = -1
+    _extrinsics: Dict[int, Tuple[int, np.typing.NDArray[np.float64], np.typing.NDArray[np.float64]]]
+    _last_rvec: Union[np.typing.NDArray[np.float64], None] = None
+    _last_tvec: Union[np.typing.NDArray[np.float64], None] = None
+
+    def __init__(self) -> None:
+        self._extrinsics = {}
+
+    def _get_layout_index(self, config_store: ConfigStore) -> TagLayoutIndex:
+        # Recompile only when the layout or tag size changes, and drop the previous pose with it
+        layout_version = config_store.field_version('tag_layout', 'tag_size_m')
+        if self._layout_index is None or layout_version != self._layout_version:
+            self._layout_index = TagLayoutIndex(config_store.remote_config.tag_layout,
+                                                config_store.remote_config.tag_size_m)
+            self._layout_version = layout_version
+            self._last_rvec = None
+        return self._layout_index
+
+    def _get_extrinsic(self, camera_index: int, camera_config: ConfigStore) -> Tuple[
+            np.typing.NDArray[np.float64], np.typing.NDArray[np.float64]]:
+        version = camera_config.field_version('robot_to_camera')
+        if camera_index not in self._extrinsics or self._extrinsics[camera_index][0] != version:
+            self._extrinsics[camera_index] = (version,) + get_camera_extrinsic(
+                camera_config.local_config.robot_to_camera)
+        return self._extrinsics[camera_index][1], self._extrinsics[camera_index][2]
+
+    def solve_robot_pose(self, camera_observations: List[CameraTagObservations],
+                         config_store: ConfigStore) -> Union[CameraPoseObservation, None]:
+        # Exit if no tag layout available
+        if config_store.remote_config.tag_layout is None:
+            return None
+        layout_index = self._get_layout_index(config_store)
+
+        # Gather the known tags of every calibrated camera with an extrinsic
+        views: List[_View] = []
+        tag_ids: List[int] = []
+        for camera_observation in camera_observations:
+            camera_config = camera_observation.config_store
+            if (not camera_config.local_config.has_calibration or
+                    len(camera_config.local_config.robot_to_camera) != 6):
+                continue
+            observed_ids = np.array([observation.tag_id for observation in camera_observation.image_observations],
+                                    dtype=np.int64)
+            known = layout_index.contains(observed_ids)
+            if not np.any(known):
+                continue
+            undistorter: Undistorter = camera_config.local_config.undistorter
+            image_points = undistorter.undistort_points(np.concatenate([
+                observation.corners.reshape(4, 2)
+                for observation, is_known in zip(camera_observation.image_observations, known) if is_known]))
+            rvec, tvec = self._get_extrinsic(camera_observation.camera_index, camera_config)
+            views.append(_View(camera_observation.camera_index, layout_index.object_points(observed_ids[known]),
+                               image_points, undistorter.camera_matrix, rvec, tvec))
+            tag_ids.extend(int(tag_id) for tag_id in observed_ids[known] if tag_id not in tag_ids)
+
+        if len(views) == 0:
+            self._last_rvec = None
+            return None
+
+        # Per-camera solutions moved to the robot, both IPPE solutions for single tags
+        candidates: List[Tuple[np.typing.NDArray[np.float64], np.typing.NDArray[np.float64]]] = []
+        if self._last_rvec is not None:
+            candidates.append((self._last_rvec, self._last_tvec))
+        for view in views:
+            try:
+                _, rvecs, tvecs, _ = cv2.solvePnPGeneric(
+                    view.object_points, view.image_points, view.camera_matrix, None,
+                    flags=cv2.SOLVEPNP_IPPE if len(view.object_points) == 4 else cv2.SOLVEPNP_SQPNP)
+            except:
+                continue
+            camera_to_robot_rvec, camera_to_robot_tvec = _invert(view.rvec, view.tvec)
+            for rvec, tvec in zip(rvecs, tvecs):
+                robot_rvec, robot_tvec = cv2.composeRT(rvec, tvec, camera_to_robot_rvec, camera_to_robot_tvec)[:2]
+                candidates.append((robot_rvec, robot_tvec))
+        if len(candidates) == 0:
+            self._last_rvec = None
+            return None
+
+        # Single tag in a single camera, return both poses
+        if len(views) == 1 and len(views[0].object_points) == 4:
+            self._last_rvec = None
+            solutions = sorted([self._refine(rvec, tvec, views) for rvec, tvec in candidates[-2:]],
+                               key=lambda solution: solution[2])
+            if len(solutions) < 2:
+                return None
+            return CameraPoseObservation(_get_field_to_camera_pose(solutions[0][0], solutions[0][1]),
+                                         solutions[0][2], _get_field_to_camera_pose(solutions[1][0], solutions[1][1]),
+                                         solutions[1][2], tag_ids)
+
+        # Refine the candidate that best explains all cameras
+        rvec, tvec = min(candidates, key=lambda candidate: self._get_error(candidate[0], candidate[1], views))
+        rvec, tvec, error = self._refine(rvec, tvec, views)
+        self._last_rvec, self._last_tvec = rvec, tvec
+        return CameraPoseObservation(_get_field_to_camera_pose(rvec, tvec), error, None, None, tag_ids)
+
+    @staticmethod
+    def _get_residuals(rvec: np.typing.NDArray[np.float64], tvec: np.typing.NDArray[np.float64], views: List[_View],
+                       jacobian: bool = False) -> Tuple[np.typing.NDArray[np.float64],
+                                                        Union[np.typing.NDArray[np.float64], None]]:
+        residuals = []
+        jacobians = []
+        for view in views:
+            # Field to camera is field to robot followed by robot to camera
+            composed = cv2.composeRT(rvec, tvec, view.rvec, view.tvec)
+            projected, projection_jacobian = cv2.projectPoints(view.object_points, composed[0], composed[1],
+                                                               view.camera_matrix, None)
+            residuals.append(projected.reshape(-1) - view.image_points.reshape(-1))
+            if jacobian:
+                # d(rvec3, tvec3) / d(rvec1, tvec1) from composeRT
+                dr3dr1, dr3dt1, dt3dr1, dt3dt1 = composed[2], composed[3], composed[6], composed[7]
+                jacobians.append(projection_jacobian[:, 0:3] @ np.hstack([dr3dr1, dr3dt1]) +
+                                 projection_jacobian[:, 3:6] @ np.hstack([dt3dr1, dt3dt1]))
+        return np.concatenate(residuals), np.vstack(jacobians) if jacobian else None
+
+    def _get_error(self, rvec: np.typing.NDArray[np.float64], tvec: np.typing.NDArray[np.float64],
+                   views: List[_View]) -> float:
+        # Same RMS reprojection error as solvePnPGeneric
+        residuals, _ = self._get_residuals(rvec, tvec, views)
+        return float(np.sqrt(np.sum(residuals ** 2) / len(residuals)))
+
+    def _refine(self, rvec: np.typing.NDArray[np.float64], tvec: np.typing.NDArray[np.float64],
+                views: List[_View]) -> Tuple[np.typing.NDArray[np.float64], np.typing.NDArray[np.float64], float]:
+        params = np.concatenate([rvec.reshape(3), tvec.reshape(3)])
+        residuals, jacobian = self._get_residuals(params[:3].reshape(3, 1), params[3:].reshape(3, 1), views, True)
+        cost = float(np.sum(residuals ** 2))
+        damping = 1e-3
+        for _ in range(self.MAX_ITERATIONS):
+            hessian = jacobian.T @ jacobian
+            gradient = jacobian.T @ residuals
+            step = np.linalg.solve(hessian + damping * np.diag(np.diag(hessian) + self.EPSILON), -gradient)
+            new_params = params + step
+            new_residuals, new_jacobian = self._get_residuals(new_params[:3].reshape(3, 1),
+                                                              new_params[3:].reshape(3, 1), views, True)
+            new_cost = float(np.sum(new_residuals ** 2))
+            if new_cost < cost:
+                params, residuals, jacobian = new_params, new_residuals, new_jacobian
+                converged = cost - new_cost < self.EPSILON * cost
+                cost = new_cost
+                damping = max(damping / 10.0, 1e-9)
+                if converged or np.linalg.norm(step) < self.EPSILON:
+                    break
+            else:
+                damping *= 10.0
+                if damping > 1e6:
+                    break
+        return params[:3].reshape(3, 1), params[3:].reshape(3, 1), float(np.sqrt(cost / len(residuals)))
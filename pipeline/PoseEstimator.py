@@ -1,7 +1,9 @@
-from typing import Union
+from typing import List, Union
 import cv2
 import numpy as np
+import numpy.typing
 from config.config import ConfigStore
+from pipeline.undistortion import Undistorter
 from vision_types import TagImageObservation, TagPoseObservation
 
 
@@ -9,20 +11,45 @@ class PoseEstimator:
     def solve_tag_pose(self, image_observation: TagImageObservation, config_store: ConfigStore) -> Union[TagPoseObservation, None]:
         raise NotImplementedError
 
+    def solve_tag_poses(self, image_observations: List[TagImageObservation], config_store: ConfigStore) -> List[Union[TagPoseObservation, None]]:
+        """Solve every tag of a frame, returning a list aligned with image_observations."""
+        return [self.solve_tag_pose(image_observation, config_store) for image_observation in image_observations]
+
 
 class SquareTargetPoseEstimator(PoseEstimator):
-    def solve_tag_pose(self, image_observation: TagImageObservation, config_store: ConfigStore) -> Union[TagPoseObservation, None]:
-        tag_size = config_store.remote_config.tag_size_m
-        object_points = np.array([[-tag_size / 2.0, tag_size / 2.0, 0.0],
-                                  [tag_size / 2.0, tag_size / 2.0, 0.0],
-                                  [tag_size / 2.0, -tag_size / 2.0, 0.0],
-                                  [-tag_size / 2.0, -tag_size / 2.0, 0.0]])
+    @staticmethod
+    def _get_object_points(tag_size: float) -> np.typing.NDArray[np.float64]:
+        return np.array([[-tag_size / 2.0, tag_size / 2.0, 0.0],
+                         [tag_size / 2.0, tag_size / 2.0, 0.0],
+                         [tag_size / 2.0, -tag_size / 2.0, 0.0],
+                         [-tag_size / 2.0, -tag_size / 2.0, 0.0]])
 
+    @staticmethod
+    def _solve(tag_id: int, object_points: np.typing.NDArray[np.float64], image_points: np.typing.NDArray[np.float64],
+               undistorter: Undistorter) -> Union[TagPoseObservation, None]:
         try:
-            _, rvecs, tvecs, errors = cv2.solvePnPGeneric(object_points, image_observation.corners,
-                                                          config_store.local_config.camera_matrix,
-                                                          config_store.local_config.distortion_coefficients,
+            _, rvecs, tvecs, errors = cv2.solvePnPGeneric(object_points, image_points, undistorter.camera_matrix, None,
                                                           flags=cv2.SOLVEPNP_IPPE_SQUARE)
         except:
             return None
-        return TagPoseObservation(image_observation.tag_id, tvecs[0], rvecs[0], errors[0][0], tvecs[1], rvecs[1], errors[1][0])
+        return TagPoseObservation(tag_id, tvecs[0], rvecs[0], errors[0][0], tvecs[1], rvecs[1], errors[1][0])
+
+    def solve_tag_pose(self, image_observation: TagImageObservation, config_store: ConfigStore) -> Union[TagPoseObservation, None]:
+        if not config_store.local_config.has_calibration:
+            return None
+
+        undistorter: Undistorter = config_store.local_config.undistorter
+        return self._solve(image_observation.tag_id, self._get_object_points(config_store.remote_config.tag_size_m),
+                           undistorter.undistort_points(image_observation.corners), undistorter)
+
+    def solve_tag_poses(self, image_observations: List[TagImageObservation], config_store: ConfigStore) -> List[Union[TagPoseObservation, None]]:
+        if not config_store.local_config.has_calibration or len(image_observations) == 0:
+            return [None] * len(image_observations)
+
+        # Undistort the corners of all tags at once
+        undistorter: Undistorter = config_store.local_config.undistorter
+        object_points = self._get_object_points(config_store.remote_config.tag_size_m)
+        image_points = undistorter.undistort_points(np.concatenate(
+            [image_observation.corners.reshape(4, 2) for image_observation in image_observations])).reshape(-1, 4, 2)
+        return [self._solve(image_observation.tag_id, object_points, tag_image_points, undistorter)
+                for image_observation, tag_image_points in zip(image_observations, image_points)]
@@ -1,7 +1,12 @@
-from typing import List
+import dataclasses
+import multiprocessing
+import pickle
+from multiprocessing import shared_memory
+from typing import Any, List, Set, Tuple, Union
 
 import cv2
-from config.config import ConfigStore
+import numpy as np
+from config.config import ConfigStore, LocalConfig, RemoteConfig
 from vision_types import TagImageObservation
 
 
@@ -9,16 +14,333 @@ class TagDetector:
     def detect_tags(self, image: cv2.Mat, config_store: ConfigStore) -> List[TagImageObservation]:
         raise NotImplementedError
 
+    def close(self) -> None:
+        """Release processes and shared memory held by the detector."""
+        pass
+
+
+def get_layout_tag_ids(tag_layout: Any) -> Union[List[int], None]:
+    """Return the sorted tag IDs in a layout, or None when there is no layout to restrict detection to."""
+    if tag_layout is None or len(tag_layout['tags']) == 0:
+        return None
+    return sorted(set(tag_data['ID'] for tag_data in tag_layout['tags']))
+
 
 class ArucoTagDetector(TagDetector):
+    REFINE_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 30, 0.01)
+
     def __init__(self, dictionary_id) -> None:
         self._aruco_dict = cv2.aruco.getPredefinedDictionary(dictionary_id)
         self._aruco_params = cv2.aruco.DetectorParameters()
         self._aruco_detector = cv2.aruco.ArucoDetector(self._aruco_dict, self._aruco_params)
+        # Maps indices of the active dictionary to tag IDs, None when the full dictionary is active
+        self._dictionary_ids: Union[np.typing.NDArray[np.int_], None] = None
+        self._layout_version = -1
 
     def detect_tags(self, image: cv2.Mat, config_store: ConfigStore) -> List[TagImageObservation]:
-        corners, ids, _ = self._aruco_detector.detectMarkers(image)
+        layout_version = config_store.field_version('tag_layout')
+        if layout_version != self._layout_version:
+            self._update_dictionary(config_store.remote_config.tag_layout)
+            self._layout_version = layout_version
+
+        decimation = config_store.remote_config.detector_decimation
+        if decimation <= 1:
+            corners, ids, _ = self._aruco_detector.detectMarkers(image)
+        else:
+            # Find candidates on a downscaled image, then refine corners on the full resolution image
+            if len(image.shape) == 3:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            decimated = cv2.resize(image, (image.shape[1] // decimation, image.shape[0] // decimation),
+                                   interpolation=cv2.INTER_AREA)
+            corners, ids, _ = self._aruco_detector.detectMarkers(decimated)
+            corners = [(corner + 0.5) * decimation - 0.5 for corner in corners]
+            if config_store.remote_config.detector_refine_window > 0:
+                corners = [self._refine_corners(image, corner, config_store.remote_config.detector_refine_window)
+                           for corner in corners]
 
         if len(corners) == 0:
             return []
-        return [TagImageObservation(tag_id[0], corner) for tag_id, corner in zip(ids, corners)]
\ No newline at end of file
+        if self._dictionary_ids is not None:
+            ids = self._dictionary_ids[ids]
+        return [TagImageObservation(tag_id[0], corner) for tag_id, corner in zip(ids, corners)]
+
+    def _update_dictionary(self, tag_layout: Any) -> None:
+        # Only decode the codes of tags on the field, unknown IDs are rejected before corner refinement
+        tag_ids = get_layout_tag_ids(tag_layout)
+        if tag_ids is not None:
+            tag_ids = [tag_id for tag_id in tag_ids if 0 <= tag_id < len(self._aruco_dict.bytesList)]
+        if tag_ids is None or len(tag_ids) == 0:
+            self._aruco_detector.setDictionary(self._aruco_dict)
+            self._dictionary_ids = None
+            return
+        self._dictionary_ids = np.array(tag_ids)
+        self._aruco_detector.setDictionary(cv2.aruco.Dictionary(
+            self._aruco_dict.bytesList[self._dictionary_ids], self._aruco_dict.markerSize,
+            self._aruco_dict.maxCorrectionBits))
+
+    def _refine_corners(self, image: cv2.Mat, corners: np.typing.NDArray[np.float32],
+                        refine_window: int) -> np.typing.NDArray[np.float32]:
+        # Keep the search window well inside the outer cells of small tags
+        points = corners.reshape(4, 2)
+        min_side = np.min(np.linalg.norm(points - np.roll(points, 1, axis=0), axis=1))
+        window = int(max(2, min(refine_window, min_side / 10)))
+        refined = cv2.cornerSubPix(image, np.ascontiguousarray(points, dtype=np.float32), (window, window), (-1, -1),
+                                   self.REFINE_CRITERIA)
+        return refined.reshape(corners.shape)
+
+
+class AprilTagDetector(TagDetector):
+    """Detects 36h11 tags with the multi-threaded AprilTag library shipped with robotpy."""
+    # AprilTag corner order mapped onto the ArUco order (top left, top right, bottom right, bottom left)
+    CORNER_ORDER = [1, 0, 3, 2]
+
+    def __init__(self) -> None:
+        import robotpy_apriltag
+        self._detector = robotpy_apriltag.AprilTagDetector()
+        self._detector.addFamily('tag36h11')
+        self._config_version = -1
+        self._layout_ids: Union[Set[int], None] = None
+        self._layout_version = -1
+
+    def detect_tags(self, image: cv2.Mat, config_store: ConfigStore) -> List[TagImageObservation]:
+        # Only reconfigure when detector settings change, setting the config restarts the worker pool
+        config_version = config_store.field_version('apriltag_threads', 'apriltag_quad_sigma', 'detector_decimation')
+        if config_version != self._config_version:
+            detector_config = self._detector.getConfig()
+            detector_config.numThreads = config_store.remote_config.apriltag_threads
+            detector_config.quadDecimate = float(max(1, config_store.remote_config.detector_decimation))
+            detector_config.quadSigma = config_store.remote_config.apriltag_quad_sigma
+            self._detector.setConfig(detector_config)
+            self._config_version = config_version
+
+        layout_version = config_store.field_version('tag_layout')
+        if layout_version != self._layout_version:
+            tag_ids = get_layout_tag_ids(config_store.remote_config.tag_layout)
+            self._layout_ids = set(tag_ids) if tag_ids is not None else None
+            self._layout_version = layout_version
+
+        if len(image.shape) == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        observations = []
+        for detection in self._detector.detect(image):
+            if detection.getDecisionMargin() < config_store.remote_config.apriltag_min_decision_margin:
+                continue
+            if self._layout_ids is not None and detection.getId() not in self._layout_ids:
+                continue
+            corners = np.array(detection.getCorners((0.0,) * 8), dtype=np.float32).reshape(4, 2)
+            observations.append(TagImageObservation(detection.getId(), corners[self.CORNER_ORDER].reshape(1, 4, 2)))
+        return observations
+
+
+class TrackingTagDetector(TagDetector):
+    """Wraps a detector to only search around the tags found in the previous frame.
+
+    The full frame is scanned every detector_full_scan_interval frames, when nothing is tracked, or when a tracked
+    tag is not found in its region of interest.
+    """
+    MIN_ROI_PADDING_PX = 16
+
+    def __init__(self, detector: TagDetector) -> None:
+        self._detector = detector
+        self._tracked: List[TagImageObservation] = []
+        self._frames_since_full_scan = 0
+
+    def detect_tags(self, image: cv2.Mat, config_store: ConfigStore) -> List[TagImageObservation]:
+        remote_config = config_store.remote_config
+        if not remote_config.detector_tracking:
+            self._tracked = []
+            return self._detector.detect_tags(image, config_store)
+
+        if len(self._tracked) == 0 or self._frames_since_full_scan >= remote_config.detector_full_scan_interval:
+            return self._full_scan(image, config_store)
+
+        # Detect in each region of interest and shift corners back to full frame coordinates
+        observations = []
+        for x_min, y_min, x_max, y_max in self._get_rois(image.shape, remote_config.detector_roi_padding):
+            roi_image = np.ascontiguousarray(image[y_min:y_max, x_min:x_max])
+            for observation in self._detector.detect_tags(roi_image, config_store):
+                corners = observation.corners + np.array([x_min, y_min], dtype=observation.corners.dtype)
+                observations.append(TagImageObservation(observation.tag_id, corners))
+
+        # Fall back to a full scan if a tracked tag was lost
+        found_ids = set(observation.tag_id for observation in observations)
+        if any(tracked.tag_id not in found_ids for tracked in self._tracked):
+            return self._full_scan(image, config_store)
+
+        self._tracked = observations
+        self._frames_since_full_scan += 1
+        return observations
+
+    def close(self) -> None:
+        self._detector.close()
+
+    def _full_scan(self, image: cv2.Mat, config_store: ConfigStore) -> List[TagImageObservation]:
+        observations = self._detector.detect_tags(image, config_store)
+        self._tracked = observations
+        self._frames_since_full_scan = 0
+        return observations
+
+    def _get_rois(self, image_shape: Tuple[int, ...], padding: float) -> List[Tuple[int, int, int, int]]:
+        height, width = image_shape[0], image_shape[1]
+
+        # Pad the bounding box of each tracked tag relative to its size
+        rois = []
+        for tracked in self._tracked:
+            points = tracked.corners.reshape(-1, 2)
+            x_min, y_min = points.min(axis=0)
+            x_max, y_max = points.max(axis=0)
+            pad = max(self.MIN_ROI_PADDING_PX, padding * max(x_max - x_min, y_max - y_min))
+            rois.append([max(0, int(x_min - pad)), max(0, int(y_min - pad)),
+                         min(width, int(np.ceil(x_max + pad))), min(height, int(np.ceil(y_max + pad)))])
+
+        # Merge overlapping regions so no tag is detected twice
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(rois)):
+                for j in range(i + 1, len(rois)):
+                    a, b = rois[i], rois[j]
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        rois[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                        del rois[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+        return [(roi[0], roi[1], roi[2], roi[3]) for roi in rois]
+
+
+def create_base_tag_detector(detector_type: str) -> TagDetector:
+    if detector_type == 'apriltag':
+        return AprilTagDetector()
+    return ArucoTagDetector(cv2.aruco.DICT_APRILTAG_36h11)
+
+
+# State of a tile worker process, set up by _init_tile_worker
+_worker_detector: Union[TagDetector, None] = None
+_worker_config = ConfigStore(LocalConfig(), RemoteConfig())
+_worker_config_version = -1
+_worker_frame: Union[shared_memory.SharedMemory, None] = None
+
+
+def _init_tile_worker(detector_type: str) -> None:
+    global _worker_detector
+    cv2.setNumThreads(1)
+    _worker_detector = create_base_tag_detector(detector_type)
+
+
+def _detect_tile(frame_name: str, frame_shape: Tuple[int, ...], tile: Tuple[int, int, int, int],
+                 config_version: int, config_data: bytes) -> List[Tuple[int, np.typing.NDArray[np.float32]]]:
+    global _worker_config_version, _worker_frame
+
+    # Attach to the frame buffer, which is only reallocated when the resolution changes
+    if _worker_frame is None or _worker_frame.name != frame_name:
+        if _worker_frame is not None:
+            _worker_frame.close()
+        # Spawned workers share the parent's resource tracker, which unlinks the buffer if the parent dies
+        _worker_frame = shared_memory.SharedMemory(name=frame_name)
+
+    # Apply remote config changes field by field so detectors see the changed field versions
+    if config_version != _worker_config_version:
+        remote_config: RemoteConfig = pickle.loads(config_data)
+        for remote_field in dataclasses.fields(RemoteConfig):
+            _worker_config.set_remote(remote_field.name, getattr(remote_config, remote_field.name))
+        _worker_config_version = config_version
+
+    x_min, y_min, x_max, y_max = tile
+    image = np.ndarray(frame_shape, dtype=np.uint8, buffer=_worker_frame.buf)
+    tile_image = np.ascontiguousarray(image[y_min:y_max, x_min:x_max])
+    offset = np.array([x_min, y_min], dtype=np.float32)
+    return [(int(observation.tag_id), observation.corners.astype(np.float32) + offset)
+            for observation in _worker_detector.detect_tags(tile_image, _worker_config)]
+
+
+class TiledTagDetector(TagDetector):
+    """Splits each frame into overlapping tiles which are detected in parallel by a pool of worker processes.
+
+    Frames are copied once into shared memory rather than pickled for each tile. Tags are only found if they fit
+    entirely in one tile, so the overlap should be larger than the biggest tag in the image. Tags found in more than
+    one tile are reported once, from the tile where they are furthest from the edge. Images too small to tile, such
+    as tracking regions of interest, are detected in this process.
+    """
+    # Detections of the same ID whose corners are this close are duplicates from overlapping tiles
+    DUPLICATE_DISTANCE_PX = 4.0
+
+    def __init__(self, detector_type: str, processes: int, rows: int, cols: int, overlap_px: int) -> None:
+        self._rows = max(1, rows)
+        self._cols = max(1, cols)
+        self._overlap_px = max(0, overlap_px)
+        self._local_detector = create_base_tag_detector(detector_type)
+        # Spawn rather than fork, the pipeline and NetworkTables threads are already running
+        self._pool = multiprocessing.get_context('spawn').Pool(processes, initializer=_init_tile_worker,
+                                                               initargs=(detector_type,))
+        self._frame: Union[shared_memory.SharedMemory, None] = None
+        self._frame_shape: Tuple[int, ...] = ()
+        self._config_version = -1
+        self._config_data = b''
+
+    def detect_tags(self, image: cv2.Mat, config_store: ConfigStore) -> List[TagImageObservation]:
+        if len(image.shape) == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        height, width = image.shape[0], image.shape[1]
+        if height // self._rows <= self._overlap_px or width // self._cols <= self._overlap_px:
+            return self._local_detector.detect_tags(image, config_store)
+
+        if self._frame is None or self._frame_shape != image.shape:
+            if self._frame is not None:
+                self._frame.close()
+                self._frame.unlink()
+            self._frame = shared_memory.SharedMemory(create=True, size=image.nbytes)
+            self._frame_shape = image.shape
+        np.ndarray(image.shape, dtype=np.uint8, buffer=self._frame.buf)[:] = image
+
+        # Only pickle the remote config when it changes
+        if config_store.version != self._config_version:
+            self._config_data = pickle.dumps(config_store.remote_config)
+            self._config_version = config_store.version
+
+        tiles = self._get_tiles(width, height)
+        tile_results = self._pool.starmap(_detect_tile, [
+            (self._frame.name, self._frame_shape, tile, self._config_version, self._config_data) for tile in tiles])
+
+        # Rank each detection by its distance to the nearest inner tile edge
+        candidates = []
+        for (x_min, y_min, x_max, y_max), detections in zip(tiles, tile_results):
+            for tag_id, corners in detections:
+                points = corners.reshape(4, 2)
+                margins = [points[:, 0].min() - x_min if x_min > 0 else np.inf,
+                           points[:, 1].min() - y_min if y_min > 0 else np.inf,
+                           x_max - points[:, 0].max() if x_max < width else np.inf,
+                           y_max - points[:, 1].max() if y_max < height else np.inf]
+                candidates.append((min(margins), tag_id, corners))
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+
+        observations: List[TagImageObservation] = []
+        for _, tag_id, corners in candidates:
+            if any(observation.tag_id == tag_id and np.max(np.linalg.norm(
+                    observation.corners.reshape(4, 2) - corners.reshape(4, 2), axis=1)) < self.DUPLICATE_DISTANCE_PX
+                   for observation in observations):
+                continue
+            observations.append(TagImageObservation(tag_id, corners))
+        return observations
+
+    def close(self) -> None:
+        self._pool.terminate()
+        self._pool.join()
+        if self._frame is not None:
+            self._frame.close()
+            self._frame.unlink()
+            self._frame = None
+
+    def _get_tiles(self, width: int, height: int) -> List[Tuple[int, int, int, int]]:
+        x_edges = np.linspace(0, width, self._cols + 1).astype(int)
+        y_edges = np.linspace(0, height, self._rows + 1).astype(int)
+        half_overlap = self._overlap_px // 2
+        tiles = []
+        for row in range(self._rows):
+            for col in range(self._cols):
+                tiles.append((max(0, int(x_edges[col]) - half_overlap), max(0, int(y_edges[row]) - half_overlap),
+                              min(width, int(x_edges[col + 1]) + half_overlap),
+                              min(height, int(y_edges[row + 1]) + half_overlap)))
+        return tiles
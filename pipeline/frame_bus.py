@@ -0,0 +1,165 @@
+import struct
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+import numpy.typing
+from vision_types import CapturedFrame
+
+# Ring buffer layout: a header, then slots of a slot header followed by the frame pixels
+MAGIC = b'PLRSBUS2'
+# magic, slot count, slot data bytes, latest sequence, closed, latest slot
+HEADER = struct.Struct('<8sIIQQQ')
+HEADER_BYTES = 64
+# lock, sequence, timestamp, height, width, channels
+SLOT_HEADER = struct.Struct('<QQdIII')
+SLOT_HEADER_BYTES = 64
+LATEST_SEQUENCE_OFFSET = 16
+CLOSED_OFFSET = 24
+LATEST_SLOT_OFFSET = 32
+LOCK = struct.Struct('<Q')
+
+
+def _slot_offset(slot: int, slot_bytes: int) -> int:
+    return HEADER_BYTES + slot * (SLOT_HEADER_BYTES + slot_bytes)
+
+
+class FrameBusWriter:
+    """Publishes captured frames to a shared memory ring buffer that other processes read without copying.
+
+    Each slot is guarded by a seqlock, a counter that is odd while the slot is written. Slots are used in turn rather
+    than by sequence number, which skips lost frames, so a frame is only overwritten after slot count newer writes.
+    The segment is recreated larger when a frame no longer fits, and the old one is marked closed so readers attach
+    again.
+    """
+
+    def __init__(self, name: str, slot_count: int) -> None:
+        self._name = name
+        self._slot_count = slot_count
+        self._slot_bytes = 0
+        self._memory: Union[shared_memory.SharedMemory, None] = None
+        self._locks: List[int] = []
+        self._write_count = 0
+
+    def write(self, sequence: int, timestamp: float, image: np.typing.NDArray[np.uint8]) -> None:
+        if self._memory is None or image.nbytes > self._slot_bytes:
+            self._create(image.nbytes)
+        buffer = self._memory.buf
+        slot = self._write_count % self._slot_count
+        self._write_count += 1
+        offset = _slot_offset(slot, self._slot_bytes)
+        channels = image.shape[2] if len(image.shape) == 3 else 1
+
+        self._locks[slot] += 1
+        LOCK.pack_into(buffer, offset, self._locks[slot])
+        SLOT_HEADER.pack_into(buffer, offset, self._locks[slot], sequence, timestamp, image.shape[0], image.shape[1],
+                              channels)
+        np.copyto(np.ndarray(image.shape, np.uint8, buffer, offset + SLOT_HEADER_BYTES), image)
+        self._locks[slot] += 1
+        LOCK.pack_into(buffer, offset, self._locks[slot])
+        struct.pack_into('<Q', buffer, LATEST_SLOT_OFFSET, slot)
+        struct.pack_into('<Q', buffer, LATEST_SEQUENCE_OFFSET, sequence)
+
+    def close(self) -> None:
+        if self._memory is not None:
+            struct.pack_into('<Q', self._memory.buf, CLOSED_OFFSET, 1)
+            self._memory.close()
+            self._memory.unlink()
+            self._memory = None
+
+    def _create(self, frame_bytes: int) -> None:
+        self.close()
+        # Leftover segment of a process that did not exit cleanly
+        try:
+            stale_memory = shared_memory.SharedMemory(name=self._name)
+            stale_memory.close()
+            stale_memory.unlink()
+        except FileNotFoundError:
+            pass
+
+        self._slot_bytes = (frame_bytes + SLOT_HEADER_BYTES - 1) // SLOT_HEADER_BYTES * SLOT_HEADER_BYTES
+        self._memory = shared_memory.SharedMemory(name=self._name, create=True,
+                                                  size=_slot_offset(self._slot_count, self._slot_bytes))
+        self._locks = [0] * self._slot_count
+        self._write_count = 0
+        HEADER.pack_into(self._memory.buf, 0, MAGIC, self._slot_count, self._slot_bytes, 0, 0, 0)
+        print('Publishing frames to shared memory ' + self._name)
+
+
+class FrameBusReader:
+    """Reads frames from a FrameBusWriter in another process.
+
+    Frames are views into the ring buffer, valid until the writer wraps around to their slot. is_current tells whether
+    a frame was overwritten while it was used, so the bus needs enough slots to cover the time frames are in use.
+    """
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._memory: Union[shared_memory.SharedMemory, None] = None
+        self._slot_count = 0
+        self._slot_bytes = 0
+        # Slot and slot lock of each frame returned recently by sequence, one per slot at most
+        self._read_locks: Dict[int, Tuple[int, int]] = {}
+
+    def get_frame(self, after_sequence: int = 0) -> Union[CapturedFrame, None]:
+        """Return the newest frame if it is newer than after_sequence, or None.
+
+        Sequence numbers restart with the writer, so any frame is newer right after attaching to a new segment.
+        """
+        if self._memory is None or struct.unpack_from('<Q', self._memory.buf, CLOSED_OFFSET)[0] != 0:
+            if not self._attach():
+                return None
+            after_sequence = 0
+        buffer = self._memory.buf
+        latest_sequence = struct.unpack_from('<Q', buffer, LATEST_SEQUENCE_OFFSET)[0]
+        if latest_sequence <= after_sequence:
+            return None
+
+        # The slot may already belong to a newer frame, which the sequence check below catches
+        slot = struct.unpack_from('<Q', buffer, LATEST_SLOT_OFFSET)[0]
+        offset = _slot_offset(slot, self._slot_bytes)
+        lock, sequence, timestamp, height, width, channels = SLOT_HEADER.unpack_from(buffer, offset)
+        if lock % 2 != 0 or sequence != latest_sequence:
+            return None
+        shape = (height, width) if channels == 1 else (height, width, channels)
+        image = np.ndarray(shape, np.uint8, buffer, offset + SLOT_HEADER_BYTES)
+        image.flags.writeable = False
+        self._read_locks[sequence] = (slot, lock)
+        if len(self._read_locks) > self._slot_count:
+            del self._read_locks[next(iter(self._read_locks))]
+        return CapturedFrame(sequence, timestamp, image)
+
+    def is_current(self, frame: CapturedFrame) -> bool:
+        """Return whether a frame returned by get_frame is unchanged, checked after using it.
+
+        Frames older than the last slot count frames returned, or from a segment the reader has since left, are
+        reported as changed.
+        """
+        read_lock = self._read_locks.get(frame.sequence)
+        if self._memory is None or read_lock is None:
+            return False
+        slot, lock = read_lock
+        return LOCK.unpack_from(self._memory.buf, _slot_offset(slot, self._slot_bytes))[0] == lock
+
+    def close(self) -> None:
+        """Detach from the segment, the next get_frame attaches to the writer's current one."""
+        # Frames still referencing the mapping keep it alive until they are released
+        self._memory = None
+
+    def _attach(self) -> bool:
+        self.close()
+        try:
+            memory = shared_memory.SharedMemory(name=self._name)
+        except FileNotFoundError:
+            return False
+        # The writer owns the segment, the reader must not unlink it on exit
+        resource_tracker.unregister(memory._name, 'shared_memory')
+        magic, slot_count, slot_bytes, _, closed, _ = HEADER.unpack_from(memory.buf, 0)
+        if magic != MAGIC or closed != 0:
+            memory.close()
+            return False
+        self._memory = memory
+        self._slot_count = slot_count
+        self._slot_bytes = slot_bytes
+        self._read_locks = {}
+        return True
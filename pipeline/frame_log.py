@@ -0,0 +1,98 @@
+import dataclasses
+import json
+import mmap
+import struct
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, Union
+
+import cv2
+import numpy as np
+import numpy.typing
+from config.config import ConfigStore
+from pipeline.undistortion import set_calibration
+
+# A recording is a file header followed by append-only chunks. Each chunk is a fixed-size header and a payload,
+# either a JSON config snapshot or a frame stored raw or as JPEG. Raw frames are read straight out of the mapped
+# file without copying.
+FILE_MAGIC = b'PLRSREC1'
+CHUNK_HEADER = struct.Struct('<4sB3xqdiiiI')
+CONFIG_CHUNK = b'CONF'
+FRAME_CHUNK = b'FRAM'
+ENCODING_RAW = 0
+ENCODING_JPEG = 1
+
+
+@dataclass(frozen=True)
+class RecordedFrame:
+    sequence: int
+    timestamp: float
+    image: np.typing.NDArray[np.uint8]
+
+
+def get_config_snapshot(config_store: ConfigStore) -> Dict[str, Any]:
+    return {
+        'local_config': {
+            'has_calibration': config_store.local_config.has_calibration,
+            'camera_matrix': config_store.local_config.camera_matrix.tolist(),
+            'distortion_coefficients': config_store.local_config.distortion_coefficients.tolist()
+        },
+        'remote_config': dataclasses.asdict(config_store.remote_config)
+    }
+
+
+def apply_config_snapshot(config_store: ConfigStore, snapshot: Dict[str, Any]) -> None:
+    local_config = snapshot['local_config']
+    if local_config['has_calibration']:
+        set_calibration(config_store, np.array(local_config['camera_matrix']),
+                        np.array(local_config['distortion_coefficients']))
+    for name, value in snapshot['remote_config'].items():
+        if hasattr(config_store.remote_config, name):
+            config_store.set_remote(name, value)
+
+
+def pack_config_chunk(config: Dict[str, Any]) -> bytes:
+    payload = json.dumps(config).encode('utf-8')
+    return CHUNK_HEADER.pack(CONFIG_CHUNK, ENCODING_RAW, 0, 0.0, 0, 0, 0, len(payload)) + payload
+
+
+def pack_frame_chunk(sequence: int, timestamp: float, image: np.typing.NDArray[np.uint8], jpeg_quality: int) -> bytes:
+    height, width = image.shape[0], image.shape[1]
+    channels = 1 if len(image.shape) == 2 else image.shape[2]
+    if jpeg_quality > 0:
+        encoding = ENCODING_JPEG
+        payload = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])[1].tobytes()
+    else:
+        encoding = ENCODING_RAW
+        payload = np.ascontiguousarray(image).tobytes()
+    return CHUNK_HEADER.pack(FRAME_CHUNK, encoding, sequence, timestamp, height, width, channels,
+                             len(payload)) + payload
+
+
+class RecordingReader:
+    """Memory-maps a recording and iterates over its config snapshots and frames."""
+
+    def __init__(self, path: str) -> None:
+        with open(path, 'rb') as recording_file:
+            self._map = mmap.mmap(recording_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(FILE_MAGIC)] != FILE_MAGIC:
+            raise ValueError('Not a polaris recording: ' + path)
+
+    def __iter__(self) -> Iterator[Union[Dict[str, Any], RecordedFrame]]:
+        offset = len(FILE_MAGIC)
+        while offset + CHUNK_HEADER.size <= len(self._map):
+            chunk_type, encoding, sequence, timestamp, height, width, channels, length = CHUNK_HEADER.unpack_from(
+                self._map, offset)
+            offset += CHUNK_HEADER.size
+            if offset + length > len(self._map):
+                break  # Truncated final chunk
+
+            if chunk_type == CONFIG_CHUNK:
+                yield json.loads(self._map[offset:offset + length].decode('utf-8'))
+            elif chunk_type == FRAME_CHUNK:
+                data = np.frombuffer(self._map, dtype=np.uint8, count=length, offset=offset)
+                if encoding == ENCODING_JPEG:
+                    image = cv2.imdecode(data, cv2.IMREAD_GRAYSCALE if channels == 1 else cv2.IMREAD_COLOR)
+                else:
+                    image = data.reshape((height, width) if channels == 1 else (height, width, channels))
+                yield RecordedFrame(sequence, timestamp, image)
+            offset += length
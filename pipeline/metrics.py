@@ -0,0 +1,65 @@
+import threading
+import time
+from typing import Dict, Tuple
+
+import numpy as np
+
+
+class LatencyHistogram:
+    """Rolling window of stage durations."""
+
+    def __init__(self, window: int) -> None:
+        self._samples = np.zeros(window)
+        self._index = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples[self._index] = seconds
+            self._index = (self._index + 1) % len(self._samples)
+            self._count += 1
+
+    def summary(self) -> Dict[str, float]:
+        with self._lock:
+            samples = self._samples[:min(self._count, len(self._samples))].copy()
+            count = self._count
+        if len(samples) == 0:
+            return {'count': 0, 'p50_ms': 0.0, 'p95_ms': 0.0, 'p99_ms': 0.0}
+        p50, p95, p99 = np.percentile(samples, [50, 95, 99]) * 1000.0
+        return {'count': count, 'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99)}
+
+
+class PipelineMetrics:
+    """Per-stage latency histograms, recorded from the pipeline threads and summarized for publishing."""
+    STAGES = ('capture_wait', 'decode', 'detect', 'solve', 'publish', 'stream')
+
+    def __init__(self, window: int = 512, stages: Tuple[str, ...] = STAGES) -> None:
+        self._histograms = {stage: LatencyHistogram(window) for stage in stages}
+
+    def record(self, stage: str, seconds: float) -> None:
+        self._histograms[stage].record(seconds)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        return {stage: histogram.summary() for stage, histogram in self._histograms.items()}
+
+
+class StartupTimer:
+    """Time from process start to each startup phase, recorded once per phase from any thread."""
+
+    def __init__(self, start_time: float) -> None:
+        self._start_time = start_time
+        self._phases: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def mark(self, phase: str) -> None:
+        with self._lock:
+            if phase in self._phases:
+                return
+            self._phases[phase] = time.monotonic() - self._start_time
+        print('Startup phase', phase, 'complete after', round(self._phases[phase] * 1000), 'ms')
+
+    def summary(self) -> Dict[str, float]:
+        """Return milliseconds since process start for each completed phase."""
+        with self._lock:
+            return {phase: seconds * 1000.0 for phase, seconds in self._phases.items()}
@@ -0,0 +1,67 @@
+from typing import Any, Dict, Tuple
+
+import numpy as np
+import numpy.typing
+from wpimath.geometry import Pose3d, Quaternion, Rotation3d, Translation3d
+
+
+def quaternion_to_rotation_matrix(w: float, x: float, y: float, z: float) -> np.typing.NDArray[np.float64]:
+    norm = np.sqrt(w * w + x * x + y * y + z * z)
+    w, x, y, z = w / norm, x / norm, y / norm, z / norm
+    return np.array([
+        [1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+        [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+        [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)]
+    ])
+
+
+class TagLayoutIndex:
+    """Tag layout compiled into a dense array of field-frame corners indexed by tag ID."""
+
+    def __init__(self, tag_layout: Any, tag_size: float) -> None:
+        tags = tag_layout['tags'] if tag_layout is not None else []
+        max_id = max([tag_data['ID'] for tag_data in tags], default=-1)
+
+        self.tag_size = tag_size
+        self.tag_poses: Dict[int, Pose3d] = {}
+        # Corners in OpenCV field coordinates, shape (max_id + 1, 4, 3)
+        self.corners = np.zeros((max_id + 1, 4, 3))
+        self.valid = np.zeros(max_id + 1, dtype=bool)
+
+        # Tag-frame corner offsets in WPILib coordinates (X out of the tag)
+        half_size = tag_size / 2.0
+        corner_offsets = np.array([[0.0, half_size, -half_size],
+                                   [0.0, -half_size, -half_size],
+                                   [0.0, -half_size, half_size],
+                                   [0.0, half_size, half_size]])
+
+        for tag_data in tags:
+            translation = tag_data['pose']['translation']
+            quaternion = tag_data['pose']['rotation']['quaternion']
+            tag_id = tag_data['ID']
+            if tag_id < 0:
+                continue
+            self.tag_poses[tag_id] = Pose3d(
+                Translation3d(translation['x'], translation['y'], translation['z']),
+                Rotation3d(Quaternion(quaternion['W'], quaternion['X'], quaternion['Y'], quaternion['Z'])))
+
+            rotation = quaternion_to_rotation_matrix(quaternion['W'], quaternion['X'], quaternion['Y'], quaternion['Z'])
+            field_corners = corner_offsets @ rotation.T + np.array([translation['x'], translation['y'], translation['z']])
+
+            # WPILib (X forward, Y left, Z up) to OpenCV (X right, Y down, Z forward)
+            self.corners[tag_id] = np.stack([-field_corners[:, 1], -field_corners[:, 2], field_corners[:, 0]], axis=1)
+            self.valid[tag_id] = True
+
+        self.tag_ids: Tuple[int, ...] = tuple(sorted(self.tag_poses.keys()))
+
+    def contains(self, tag_ids: np.typing.NDArray[np.int_]) -> np.typing.NDArray[np.bool_]:
+        """Return a mask of which tag IDs are present in the layout."""
+        in_range = (tag_ids >= 0) & (tag_ids < len(self.valid))
+        mask = np.zeros(len(tag_ids), dtype=bool)
+        mask[in_range] = self.valid[tag_ids[in_range]]
+        return mask
+
+    def object_points(self, tag_ids: np.typing.NDArray[np.int_]) -> np.typing.NDArray[np.float64]:
+        """Return the field-frame corners of the given (known) tag IDs, shape (len(tag_ids) * 4, 3)."""
+        return self.corners[tag_ids].reshape(-1, 3)
+
@@ -0,0 +1,37 @@
+import cv2
+import numpy as np
+import numpy.typing
+from config.config import ConfigStore
+
+
+class Undistorter:
+    """Calibration data precomputed once per calibration, for solving in ideal pinhole coordinates.
+
+    Undistorted points are in pixels of a distortion free camera with the same camera matrix, so solvers pass
+    camera_matrix with no distortion coefficients and reprojection errors stay in pixels.
+    """
+    CRITERIA = (cv2.TERM_CRITERIA_COUNT + cv2.TERM_CRITERIA_EPS, 10, 1e-8)
+
+    def __init__(self, camera_matrix: np.typing.NDArray[np.float64],
+                 distortion_coefficients: np.typing.NDArray[np.float64]) -> None:
+        self.camera_matrix = np.asarray(camera_matrix, dtype=np.float64).reshape(3, 3)
+        self.distortion_coefficients = np.asarray(distortion_coefficients, dtype=np.float64).reshape(1, -1)
+        self._has_distortion = bool(np.any(self.distortion_coefficients != 0.0))
+
+    def undistort_points(self, points: np.typing.NDArray[np.float64]) -> np.typing.NDArray[np.float64]:
+        """Map distorted pixel points to ideal pixel points of shape (N, 2), in one batch."""
+        points = np.ascontiguousarray(points, dtype=np.float64).reshape(-1, 1, 2)
+        if not self._has_distortion:
+            return points.reshape(-1, 2)
+        return cv2.undistortPointsIter(points, self.camera_matrix, self.distortion_coefficients, None,
+                                       self.camera_matrix, self.CRITERIA).reshape(-1, 2)
+
+
+def set_calibration(config_store: ConfigStore, camera_matrix: np.typing.NDArray[np.float64],
+                    distortion_coefficients: np.typing.NDArray[np.float64]) -> None:
+    """Set the calibration, rebuilding the undistorter only when it changed."""
+    changed = config_store.set_local('camera_matrix', camera_matrix)
+    changed = config_store.set_local('distortion_coefficients', distortion_coefficients) or changed
+    if changed or config_store.local_config.undistorter is None:
+        config_store.set_local('undistorter', Undistorter(camera_matrix, distortion_coefficients))
+    config_store.set_local('has_calibration', True)
@@ -0,0 +1,31 @@
+import fcntl
+import os
+import struct
+
+# ioctl request and control IDs from linux/videodev2.h and linux/v4l2-controls.h
+VIDIOC_S_CTRL = 0xC008561C
+V4L2_CID_EXPOSURE_AUTO = 0x009A0901
+V4L2_CID_EXPOSURE_ABSOLUTE = 0x009A0902
+V4L2_CID_GAIN = 0x00980913
+
+# struct v4l2_control { __u32 id; __s32 value; }
+V4L2_CONTROL = struct.Struct('Ii')
+
+
+class V4L2Controls:
+    """Sets controls of a V4L2 device through a second file descriptor, while another process or pipeline streams."""
+
+    def __init__(self, device: str) -> None:
+        self._fd = os.open(device, os.O_RDWR | os.O_NONBLOCK)
+
+    def set_control(self, control_id: int, value: int) -> bool:
+        """Set a control, returning whether the driver accepted it."""
+        try:
+            fcntl.ioctl(self._fd, VIDIOC_S_CTRL, V4L2_CONTROL.pack(control_id, value))
+            return True
+        except OSError as e:
+            print('Failed to set V4L2 control ' + hex(control_id) + ':', e)
+            return False
+
+    def close(self) -> None:
+        os.close(self._fd)
@@ -1,68 +1,167 @@
 import time
 
-import cv2
-import ntcore
-
-from config.config import ConfigStore, LocalConfig, RemoteConfig
-from config.ConfigSource import ConfigSource, FileConfigSource, NTConfigSource
-from output.OutputPublisher import NT4OutputPublisher, OutputPublisher
-from output.overlay_util import *
-from output.StreamServer import MjpegServer
-from pipeline.CameraPoseEstimator import MultiTargetCameraPoseEstimator
-from pipeline.Capture import GStreamerCapture
-from pipeline.TagDetector import ArucoTagDetector
-
-def main():
-    config = ConfigStore(LocalConfig(), RemoteConfig())
-    local_config_source: ConfigSource = FileConfigSource()
-    remote_config_source: ConfigSource = NTConfigSource()
-
-    capture = GStreamerCapture()
-    tag_detector = ArucoTagDetector(cv2.aruco.DICT_APRILTAG_36h11)
-    pose_estimator = MultiTargetCameraPoseEstimator()
-    output_publisher: OutputPublisher = NT4OutputPublisher()
-    stream_server = MjpegServer()
+# Taken before any other imports so import time is included in the startup timings
+STARTUP_TIME = time.monotonic()
 
-    local_config_source.update(config)
+import argparse
+import functools
+import threading
+from typing import List
 
-    if not config.local_config.has_calibration:
-        print('No calibration found')
-        exit(1)
-
-    ntcore.NetworkTableInstance.getDefault().setServer(config.local_config.server_ip)
-    ntcore.NetworkTableInstance.getDefault().startClient4(config.local_config.device_id)
-    stream_server.start(config)
-
-    frame_count = 0
-    last_print = 0
+import ntcore
 
-    while True:
-        remote_config_source.update(config)
-        success, image = capture.get_frame(config)
-        timestamp = time.time()
+from config.config import ConfigStore, LocalConfig, RemoteConfig
+from config.ConfigSource import CalibrationConfigSource, ConfigSource, FileConfigSource, NTConfigSource
+from pipeline.Capture import Capture, GStreamerCapture, ReplayCapture, SharedMemoryCapture
+from pipeline.metrics import StartupTimer
 
-        if not success:
-            time.sleep(0.5)
-            continue
 
-        fps = None
-        frame_count += 1
-        if time.time() - last_print > 1:
-            last_print = time.time()
-            fps = frame_count
-            print('Running at', frame_count, 'fps')
-            frame_count = 0
+class Camera:
+    """Config and capture of one camera, which runs its own pipeline."""
 
-        image_observations = tag_detector.detect_tags(image, config)
-        pose_observation = pose_estimator.solve_camera_pose(image_observations, config)
+    def __init__(self, config: ConfigStore, config_sources: List[ConfigSource], capture: Capture) -> None:
+        self.config = config
+        self.config_sources = config_sources
+        self.capture = capture
 
-        for obs in image_observations:
-            overlay_image_observation(image, obs)
 
-        output_publisher.send(config, timestamp, pose_observation, fps)
+def main():
+    startup_timer = StartupTimer(STARTUP_TIME)
+    startup_timer.mark('imports')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replay', help='replay a recording instead of capturing from the camera')
+    parser.add_argument('--replay-fast', action='store_true', help='replay frames as fast as they are processed')
+    args = parser.parse_args()
+
+    # The top level of config.json configures the device and each entry of its cameras list one camera. Replays
+    # only run the first camera.
+    device_config = ConfigStore(LocalConfig(), RemoteConfig())
+    FileConfigSource().update(device_config)
+    camera_count = FileConfigSource.get_camera_count()
+    camera_indices = [None] if camera_count == 0 else list(range(1 if args.replay is not None else camera_count))
+    fuse_cameras = device_config.local_config.fuse_cameras and len(camera_indices) > 1
+
+    cameras: List[Camera] = []
+    for camera_index in camera_indices:
+        config = ConfigStore(LocalConfig(), RemoteConfig())
+        FileConfigSource(camera_index).update(config)
+
+        # Recordings carry their own calibration and remote config, so replays ignore NetworkTables config and are
+        # reproducible. Otherwise the calibration follows the camera resolution.
+        capture: Capture
+        config_sources: List[ConfigSource] = []
+        if args.replay is not None:
+            capture = ReplayCapture(args.replay, realtime=not args.replay_fast)
+            capture.apply_initial_config(config)
+        else:
+            # Frames from another process's frame bus, or straight from the camera
+            if config.local_config.frame_bus_source != '':
+                capture = SharedMemoryCapture(config.local_config.frame_bus_source)
+            else:
+                capture = GStreamerCapture()
+            config_sources = [NTConfigSource(), CalibrationConfigSource(config.local_config.calibration_file)]
+        cameras.append(Camera(config, config_sources, capture))
+
+    nt_instance = ntcore.NetworkTableInstance.getDefault()
+    connection_listener = nt_instance.addConnectionListener(False, lambda event: startup_timer.mark('nt_connected'))
+    nt_instance.setServer(device_config.local_config.server_ip)
+    nt_instance.startClient4(device_config.local_config.device_id)
+
+    # Apply the cached remote config, then open the cameras while NetworkTables connects and the rest loads
+    for camera in cameras:
+        for config_source in camera.config_sources:
+            config_source.update(camera.config)
+        # A resolution without a matching calibration is reported by CalibrationConfigSource and can still be
+        # corrected over NetworkTables, so only a camera without any calibration stops startup
+        calibration_sources = [config_source for config_source in camera.config_sources
+                               if isinstance(config_source, CalibrationConfigSource)]
+        if (not camera.config.local_config.has_calibration and
+                not any(source.has_calibrations(camera.config) for source in calibration_sources)):
+            print('No calibration found for ' + camera.config.local_config.device_id)
+            nt_instance.removeListener(connection_listener)
+            exit(1)
+        if fuse_cameras and len(camera.config.local_config.robot_to_camera) != 6:
+            print('No robot_to_camera for ' + camera.config.local_config.device_id + ', its tags are not fused')
+    startup_timer.mark('config')
+
+    def open_cameras() -> None:
+        open_threads = [threading.Thread(target=camera.capture.open, args=(camera.config,), daemon=True)
+                        for camera in cameras]
+        for open_thread in open_threads:
+            open_thread.start()
+        for open_thread in open_threads:
+            open_thread.join()
+        startup_timer.mark('camera_open')
+
+    camera_thread = threading.Thread(target=open_cameras, name='camera-open', daemon=True)
+    camera_thread.start()
+
+    # Modules only needed once frames arrive are imported while the cameras open
+    from output.OutputPublisher import NT4OutputPublisher
+    from output.StreamServer import MjpegServer
+    from pipeline.CameraPoseEstimator import MultiTargetCameraPoseEstimator
+    from pipeline.frame_bus import FrameBusWriter
+    from pipeline.FramePipeline import FramePipeline, FusionPipeline
+    from pipeline.FusedPoseEstimator import FusedPoseEstimator
+    from pipeline.PoseEstimator import SquareTargetPoseEstimator
+    from pipeline.TagDetector import (TagDetector, TiledTagDetector, TrackingTagDetector,
+                                      create_base_tag_detector)
+
+    # One HTTP server for all cameras, a single camera streams at the root and multiple cameras under their device ID
+    stream_server = MjpegServer()
 
-        stream_server.set_frame(image)
+    # Fused cameras publish one robot pose under the device ID instead of a camera pose each
+    fusion_pipeline = None
+    if fuse_cameras:
+        fusion_pipeline = FusionPipeline(device_config, [NTConfigSource()], [camera.config for camera in cameras],
+                                         FusedPoseEstimator(), NT4OutputPublisher(), startup_timer)
+
+    pipelines: List[FramePipeline] = []
+    for camera_index, camera in enumerate(cameras):
+        config = camera.config
+        stream = stream_server.add_stream('' if camera_count == 0 else config.local_config.device_id)
+        stream.start(config)
+
+        frame_recorder = None
+        if config.local_config.record_path != '' and args.replay is None:
+            from output.FrameRecorder import FrameRecorder
+            frame_recorder = FrameRecorder()
+            frame_recorder.start(config)
+
+        frame_bus = None
+        if config.local_config.frame_bus_name != '':
+            frame_bus = FrameBusWriter(config.local_config.frame_bus_name, config.local_config.frame_bus_slots)
+
+        def create_tag_detector(local_config: LocalConfig = config.local_config) -> TagDetector:
+            if local_config.detector_tile_processes > 0:
+                return TrackingTagDetector(TiledTagDetector(
+                    local_config.detector, local_config.detector_tile_processes, local_config.detector_tile_rows,
+                    local_config.detector_tile_cols, local_config.detector_tile_overlap_px))
+            return TrackingTagDetector(create_base_tag_detector(local_config.detector))
+
+        pipelines.append(FramePipeline(config, camera.config_sources, camera.capture, create_tag_detector,
+                                       MultiTargetCameraPoseEstimator(), NT4OutputPublisher(), stream,
+                                       frame_recorder, lossless=args.replay_fast, startup_timer=startup_timer,
+                                       fusion_input=None if fusion_pipeline is None else functools.partial(
+                                           fusion_pipeline.put, camera_index),
+                                       frame_bus=frame_bus, tag_pose_estimator=SquareTargetPoseEstimator()))
+    stream_server.start(device_config.local_config.stream_port)
+
+    camera_thread.join()
+    if fusion_pipeline is not None:
+        fusion_pipeline.start()
+    for pipeline in pipelines:
+        pipeline.start()
+    startup_timer.mark('pipeline_started')
+    for pipeline in pipelines:
+        pipeline.join()
+    # Pipelines only stop at the end of a replay
+    for pipeline in pipelines:
+        pipeline.print_summary()
+    # A listener still registered at exit aborts the process
+    nt_instance.removeListener(connection_listener)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
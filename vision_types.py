@@ -26,3 +26,9 @@ class CameraPoseObservation:
     pose_1: Union[Pose3d, None]
     error_1: Union[float, None]
     tag_ids: List[int]
+
+@dataclass(frozen=True)
+class CapturedFrame:
+    sequence: int
+    timestamp: float
+    image: np.typing.NDArray[np.uint8]